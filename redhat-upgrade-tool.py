@@ -28,7 +28,9 @@ from subprocess import CalledProcessError, Popen, PIPE
 from ConfigParser import NoOptionError, RawConfigParser
 
 from redhat_upgrade_tool.util import call, check_call, check_output, rm_f, mkdir_p, rlistdir, kernelver
+from redhat_upgrade_tool.util import hrsize, PhaseTimer
 from redhat_upgrade_tool.download import UpgradeDownloader, YumBaseError, yum_plugin_for_exc, URLGrabError
+from redhat_upgrade_tool.download import PackageRecord
 from redhat_upgrade_tool.sysprep import prep_upgrade, prep_boot, setup_media_mount, setup_cleanup_post, disable_old_repos, Config
 from redhat_upgrade_tool.sysprep import modify_repos, remove_cache, reset_boot
 from redhat_upgrade_tool.boot import upgrade_boot_args
@@ -37,7 +39,14 @@ from redhat_upgrade_tool.rollback.bootloader import boom_cleanup, restore_boot,
 from redhat_upgrade_tool.rollback.snapshot import LVM, SnapshotError
 from redhat_upgrade_tool.rollback.preparecleanup import create_cleanup_script, dump_target_kernelver
 from redhat_upgrade_tool.rollback.cleanup_script import clean_rut_boot_dirs
-from redhat_upgrade_tool.upgrade import RPMUpgrade, TransactionError
+from redhat_upgrade_tool.upgrade import TransactionError
+from redhat_upgrade_tool.upgrade import TestResults, test_fingerprint
+from redhat_upgrade_tool.upgrade import run_test_worker, TransactionWorkerError
+from redhat_upgrade_tool.upgrade import timing_record, save_timing
+from redhat_upgrade_tool.upgrade import save_problem_report
+from redhat_upgrade_tool.upgrade import diskspace_problems
+from redhat_upgrade_tool.pkgcache import HeaderCache
+from redhat_upgrade_tool.manifest import verify_manifest
 
 from redhat_upgrade_tool.commandline import parse_args, do_cleanup, device_setup
 from redhat_upgrade_tool import textoutput as output
@@ -65,9 +74,16 @@ def message(m):
 
 
 def setup_downloader(version, instrepo=None, cacheonly=False, repos=[],
-                     enable_plugins=[], disable_plugins=[], noverifyssl=False):
+                     enable_plugins=[], disable_plugins=[], noverifyssl=False,
+                     download_workers=4, mirror_workers=4, cache_quota=0,
+                     cache_max_age=None, deltarpm=False):
     log.debug("setup_downloader(version=%s, repos=%s)", version, repos)
-    f = UpgradeDownloader(version=version, cacheonly=cacheonly)
+    f = UpgradeDownloader(version=version, cacheonly=cacheonly,
+                          download_workers=download_workers,
+                          mirror_workers=mirror_workers,
+                          cache_quota=cache_quota,
+                          cache_max_age=cache_max_age,
+                          deltarpm=deltarpm)
     f.preconf.enabled_plugins += enable_plugins
     f.preconf.disabled_plugins += disable_plugins
     f.instrepoid = instrepo
@@ -86,8 +102,20 @@ def setup_downloader(version, instrepo=None, cacheonly=False, repos=[],
     return f
 
 
-def download_packages(f):
-    updates = f.build_update_transaction(callback=output.DepsolveCallback(f))
+def check_disk_space(f, pkgs):
+    short = f.estimate_disk_space(pkgs).shortfall()
+    if short:
+        err = TransactionError(diskspace_problems(short))
+        message(_("Not enough free disk space for the upgrade:"))
+        for s in err.summaries:
+            for line in s.format_details():
+                message("  " + line)
+        raise SystemExit(1)
+
+
+def download_packages(f, pipeline=False, space_check=True):
+    updates = f.build_update_transaction(callback=output.DepsolveCallback(f),
+                                         prefetch=pipeline)
     # check for empty upgrade transaction
     if not updates:
         print _('No upgrade found, please check the repository specified is correct.')
@@ -101,18 +129,50 @@ def download_packages(f):
             print "  " + p
     # clean out any unneeded packages from the cache
     f.clean_cache(keepfiles=(p.localPkg() for p in updates))
+    # make sure everything will fit before we download it all
+    if space_check:
+        check_disk_space(f, updates)
     # download packages
     f.download_packages(updates, callback=output.DownloadCallback())
 
     return updates
 
 
-def transaction_test(pkgs):
-    print _("testing upgrade transaction")
+def packages_without_updates(f):
+    return [str(p) for p in sorted(f.find_packages_without_updates(),
+                                   key=lambda p:p.nevra)]
+
+
+def transaction_test(pkgs, force=False):
     pkgfiles = set(po.localPkg() for po in pkgs)
-    fu = RPMUpgrade()
-    probs = fu.setup_transaction(pkgfiles=pkgfiles, check_fatal=False)
-    rv = fu.test_transaction(callback=output.TransactionCallback(numpkgs=len(pkgfiles)))
+    # if nothing has changed since the last test, its results still apply
+    results = TestResults()
+    fingerprint = test_fingerprint(pkgfiles)
+    saved = None if force else results.load(fingerprint)
+    if saved:
+        print _("upgrade transaction unchanged since last test, "
+                "reusing results")
+        probs, testerr, rv = saved
+    else:
+        print _("testing upgrade transaction")
+        # the test runs in a separate process; only the progress comes back
+        hdrcache = HeaderCache()
+        callback = output.TransactionCallback(numpkgs=len(pkgfiles))
+        timer = PhaseTimer()
+        probs, testerr, rv = run_test_worker(pkgfiles, callback,
+                                             hdrcache=hdrcache, timer=timer)
+        save_timing(timing_record(timer, callback))
+        count, size = hdrcache.size()
+        log.info("header cache: %u headers, %s", count, hrsize(size))
+        results.save(fingerprint, probs, testerr, rv)
+    # write out all the problems for anything that wants to parse them
+    problems = []
+    for err in (probs, testerr):
+        if err:
+            problems.extend(err.problems)
+    save_problem_report(problems)
+    if testerr:
+        raise testerr
     return (probs, rv)
 
 
@@ -239,8 +299,10 @@ def main(args):
         return
     else:
         # Leaving cache from previous runs of the tool could foil the correct
-        # download of packages for upgrade (bz#1303982)
-        remove_cache()
+        # download of packages for upgrade (bz#1303982). The packages and
+        # boot images themselves are checked against the new metadata, so
+        # keep those.
+        remove_cache(keep_packages=True)
 
     if args.device or args.iso:
         device_setup(args)
@@ -253,7 +315,12 @@ def main(args):
                          repos=args.repos,
                          enable_plugins=args.enable_plugins,
                          disable_plugins=args.disable_plugins,
-                         noverifyssl=args.noverifyssl)
+                         noverifyssl=args.noverifyssl,
+                         download_workers=args.download_workers,
+                         mirror_workers=args.mirror_workers,
+                         cache_quota=args.cache_quota,
+                         cache_max_age=args.cache_max_age,
+                         deltarpm=args.deltarpm)
 
     if not args.force:
         check_preupg_target_system_version(f.treeinfo)
@@ -287,7 +354,12 @@ def main(args):
                                      repos=args.repos,
                                      enable_plugins=args.enable_plugins,
                                      disable_plugins=args.disable_plugins,
-                                     noverifyssl=args.noverifyssl)
+                                     noverifyssl=args.noverifyssl,
+                                     download_workers=args.download_workers,
+                                     mirror_workers=args.mirror_workers,
+                                     cache_quota=args.cache_quota,
+                                     cache_max_age=args.cache_max_age,
+                                     deltarpm=args.deltarpm)
         except NoOptionError:
             log.debug("No product name found, skipping gpg check")
 
@@ -340,6 +412,7 @@ def main(args):
             else:
                 dump_target_kernelver(kv)
 
+    probs = None
     if args.skippkgs:
         message("skipping package download")
     else:
@@ -347,15 +420,37 @@ def main(args):
         if len(f.pkgSack) == 0:
             print("no updates available in configured repos!")
             raise SystemExit(1)
-        pkgs = download_packages(f)
+        pkgs = download_packages(f, pipeline=args.pipeline_downloads,
+                                 space_check=not args.no_space_check)
+        # quick check for file conflicts before the (much slower) test
+        conflicts = f.find_file_conflicts(pkgs)
+        if conflicts:
+            print _("WARNING: file conflicts found:")
+            for s in TransactionError(conflicts).summaries:
+                for line in s.format_details():
+                    print "  " + line
+        # keep just what we need to know about the packages, and let go of
+        # yum's package data before the test transaction. the summary at
+        # the end needs the rpmdb, so do that part of it now.
+        missing = packages_without_updates(f)
+        pkgs = [PackageRecord.from_po(po) for po in pkgs]
+        f.release_packages()
         # Run a test transaction
-        probs, rv = transaction_test(pkgs)
+        probs, rv = transaction_test(pkgs, force=args.force_test)
 
     # And prepare for upgrade
     # TODO: use polkit to get root privs for these things
     print _("setting up system for upgrade")
     if not args.skippkgs:
         prep_upgrade(pkgs)
+        # make sure everything in package.list made it there intact
+        # (the media isn't set up until the upgrade starts)
+        bad = verify_manifest(skip_media=True)
+        if bad:
+            message(_("Some packages could not be staged for the upgrade:"))
+            for name, problem in bad:
+                message("  %s: %s" % (name, problem))
+            raise SystemExit(1)
 
     # Disable the RHEL-6 repos
     disable_old_repos()
@@ -434,7 +529,8 @@ def main(args):
     # --- Here's where we summarize potential problems. ---
 
     # list packages without updates, if any
-    missing = sorted(f.find_packages_without_updates(), key=lambda p:p.nevra)
+    if args.skippkgs:
+        missing = packages_without_updates(f)
     if missing and not major_upgrade:
         message(_('Packages without updates:'))
         for p in missing:
@@ -595,6 +691,11 @@ if __name__ == '__main__':
             log.debug(p)
         log.error(_("Upgrade test failed."))
         raise SystemExit(3)
+    except TransactionWorkerError as e:
+        print
+        message(_("Upgrade test could not be run: %s") % e)
+        log.error(_("Upgrade test failed."))
+        raise SystemExit(3)
     except Exception as e:
         pluginfile = yum_plugin_for_exc()
         if pluginfile:
@@ -47,8 +47,16 @@ kernelpath = '/boot/vmlinuz-%s' % kernel_id
 initrdpath = '/boot/initramfs-%s.img' % kernel_id
 
 cachedir = '/var/tmp/system-upgrade'
+verifyindex = os.path.join(cachedir, 'verified.conf')
+depsolvecache = os.path.join(cachedir, 'depsolve.json')
+pkgcacheconf = os.path.join(cachedir, 'pkgcache.conf')
+headercachedir = os.path.join(cachedir, 'headers')
+testresults = os.path.join(cachedir, 'test-results.json')
+timingfile = '/var/log/%s-timing.json' % __package__
+problemreport = '/var/log/%s-problems.json' % __package__
 packagedir = '/var/lib/system-upgrade'
 packagelist = os.path.join(packagedir, 'package.list')
+packagemanifest = os.path.join(packagedir, 'package.manifest')
 upgradeconf = os.path.join(packagedir, 'upgrade.conf')
 upgradelink = '/system-upgrade'
 upgraderoot = '/system-upgrade-root'
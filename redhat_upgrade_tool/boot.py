@@ -17,14 +17,22 @@
 #
 # Author: Will Woods <wwoods@redhat.com>
 
-from .util import check_output, check_call, PIPE, Popen, CalledProcessError
-from shutil import copyfileobj
+import os
+import stat
+import errno
+from gzip import GzipFile
+
+from .util import check_output, check_call
+from .stage import copy_data, copy_methods
 
 import logging
 log = logging.getLogger(__package__+".boot")
 
 kernelprefix = "/boot/vmlinuz-"
 
+# reflinks replace the whole target file, so they're no good for appending
+append_methods = tuple(m for m in copy_methods if m[0] != 'reflink')
+
 def kernelver(kernel):
     if kernel.startswith(kernelprefix):
         return kernel.split(kernelprefix,1)[1]
@@ -54,27 +62,93 @@ def remove_entry(kernel):
     cmd = ["new-kernel-pkg", "--remove", kernelver(kernel)]
     return check_output(cmd)
 
-def initramfs_append_files(initramfs, files):
+class CpioWriter(object):
+    '''
+    Writes a cpio archive in the "newc" format (the one the kernel unpacks
+    for an initramfs) to a file object, streaming the contents of each file
+    straight into it.
+    '''
+    magic = "070701"
+    trailer = "TRAILER!!!"
+
+    def __init__(self, fileobj, bufsize=2**20):
+        self.fileobj = fileobj
+        self.bufsize = bufsize
+        self.ino = 0
+        self.offset = 0
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.offset += len(data)
+
+    def _pad(self):
+        self._write('\0' * (-self.offset % 4))
+
+    def _header(self, name, mode=0, size=0, mtime=0, nlink=1, uid=0, gid=0):
+        self.ino += 1
+        fields = (self.ino, mode, uid, gid, nlink, mtime, size,
+                  0, 0, 0, 0, len(name) + 1, 0)
+        self._write(self.magic + ''.join("%08X" % f for f in fields))
+        self._write(name + '\0')
+        self._pad()
+
+    def add_file(self, path, name=None):
+        '''add the file at path to the archive (as name, which defaults to
+           path without the leading '/')'''
+        if name is None:
+            name = path.lstrip('/')
+        with open(path, 'rb') as infd:
+            st = os.fstat(infd.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                raise IOError(errno.EINVAL, "not a regular file", path)
+            self._header(name, st.st_mode, st.st_size, int(st.st_mtime),
+                         uid=st.st_uid, gid=st.st_gid)
+            copied = 0
+            while copied < st.st_size:
+                data = infd.read(min(self.bufsize, st.st_size - copied))
+                if not data:
+                    raise IOError(errno.EIO, "file shrank while reading", path)
+                self._write(data)
+                copied += len(data)
+        self._pad()
+
+    def close(self):
+        '''write the trailer that ends the archive'''
+        self._header(self.trailer)
+
+def initramfs_append(initramfs, files=(), images=(), compress=False):
+    '''Append the given files (as a cpio archive, gzipped if compress is
+       True) and images (which must already be cpio archives, compressed
+       or not) to the named initramfs, in one pass.
+       Raises IOError if the files can't be read/written.'''
+    with open(initramfs, 'r+b') as outfd:
+        outfd.seek(0, 2)
+        if files:
+            outf = outfd
+            if compress:
+                outf = GzipFile(fileobj=outfd, mode='wb')
+            cpio = CpioWriter(outf)
+            for f in files:
+                cpio.add_file(f)
+            cpio.close()
+            if compress:
+                outf.close() # doesn't close outfd, just finishes the gzip data
+        for i in images:
+            with open(i, 'rb') as infd:
+                copy_data(infd, outfd, os.fstat(infd.fileno()).st_size,
+                          methods=append_methods)
+
+def initramfs_append_files(initramfs, files, compress=False):
     '''Append the given files to the named initramfs.
-       Raises IOError if the files can't be read/written.
-       Raises CalledProcessError if cpio returns a non-zero exit code.'''
+       Raises IOError if the files can't be read/written.'''
     if isinstance(files, basestring):
         files = [files]
-    filelist = ''.join(f+'\n' for f in files if open(f))
-    with open(initramfs, 'ab') as outfd:
-        cmd = ["cpio", "-co"]
-        cpio = Popen(cmd, stdin=PIPE, stdout=outfd, stderr=PIPE)
-        (out, err) = cpio.communicate(input=filelist)
-        if cpio.returncode:
-            raise CalledProcessError(cpio.returncode, cmd, err)
+    initramfs_append(initramfs, files=files, compress=compress)
 
 def initramfs_append_images(initramfs, images):
     '''Append the given images to the named initramfs.
        Raises IOError if the files can't be read/written.'''
-    with open(initramfs, 'ab') as outfd:
-        for i in images:
-            with open(i, 'rb') as infd:
-                copyfileobj(infd, outfd)
+    initramfs_append(initramfs, images=images)
 
 def need_mdadmconf():
     '''Does this system need /etc/mdadm.conf to boot?'''
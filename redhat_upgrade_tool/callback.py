@@ -18,7 +18,9 @@
 #
 # Author: Will Woods <wwoods@redhat.com>
 
+import os
 import rpm
+import time
 import logging
 from rpmUtils.miscutils import formatRequire
 from yum.callbacks import ProcessTransBaseCallback
@@ -44,6 +46,7 @@ class BaseTsCallback(object):
 
     def __init__(self):
         self._openfds = dict()
+        self._stats = dict() # name -> [count, seconds]
         self.log = logging.getLogger(__package__+".rpm")
 
     def callback(self, what, amount, total, key, data):
@@ -52,9 +55,21 @@ class BaseTsCallback(object):
             return
         name = self.callback_map[what]
         #self.log.debug("%s(%s, %s, %s, %s)", name, amount, total, key, data)
+        stats = self._stats.setdefault(name, [0, 0.0])
+        stats[0] += 1
         func = getattr(self, name, None)
         if callable(func):
-            return func(amount, total, key, data)
+            start = time.time()
+            try:
+                return func(amount, total, key, data)
+            finally:
+                stats[1] += time.time() - start
+
+    def callback_stats(self):
+        '''return {name: {'count': n, 'seconds': s}} for each type of
+           callback seen so far'''
+        return dict((name, dict(count=count, seconds=round(seconds, 3)))
+                    for (name, (count, seconds)) in self._stats.iteritems())
 
     def openfile(self, filename):
         f = open(filename, 'r')
@@ -101,6 +116,11 @@ class DownloadCallbackBase(ProcessTransBaseCallback):
         shortname = filename.split('/')[-1]
         self.log.debug("verifying %u/%u %s", amount, total, shortname)
 
+    # 'fetch' callback for PackageFetcher; data is the error message, if any
+    def fetch(self, amount, total, filename, data):
+        shortname = filename.split('/')[-1]
+        self.log.debug("fetched %u/%u %s", amount, total, shortname)
+
 # callback object for depsolving
 
 class DepsolveCallbackBase(object):
@@ -49,8 +49,13 @@ def parse_args(gui=False):
 
     p.add_option('--no-space-check', action='store_true', default=False,
                  help=_('disable check of free space in /boot. By default the'
-                        ' required minimum before reboot is 50 MiB. Use it at'
-                        ' your own risk.'))
+                        ' required minimum before reboot is 50 MiB. This also'
+                        ' disables the check for enough free space for the'
+                        ' upgrade before downloading. Use it at your own'
+                        ' risk.'))
+    p.add_option('--force-test', action='store_true', default=False,
+        help=_('run the upgrade test transaction even if nothing has changed'
+               ' since the last one'))
     p.add_option('--cleanup-post', action='store_true', default=False,
             help=_('cleanup old package after the upgrade'))
 
@@ -95,6 +100,25 @@ def parse_args(gui=False):
         help=_('disable yum plugins by name'))
     yumopts.add_option('--nogpgcheck', action='store_true', default=False,
         help=_('disable GPG signature checking'))
+    yumopts.add_option('--download-workers', metavar='N', type='int',
+        default=4, help=_('download up to N packages from each repo at once'
+                          ' (default: %default)'))
+    yumopts.add_option('--mirror-workers', metavar='N', type='int',
+        default=4, help=_('download up to N packages from each mirror at once'
+                          ' (default: %default)'))
+    yumopts.add_option('--pipeline-downloads', action='store_true',
+        default=False, help=_('start downloading packages while the upgrade'
+                              ' transaction is still being built'))
+    yumopts.add_option('--cache-quota', metavar='MB', type='int', default=0,
+        help=_('keep up to MB MiB of packages that aren\'t needed for this'
+               ' upgrade in the cache, in case they\'re needed later'
+               ' (default: %default)'))
+    yumopts.add_option('--cache-max-age', metavar='DAYS', type='int',
+        default=30, help=_('remove cached packages that haven\'t been used'
+                           ' for DAYS days (default: %default)'))
+    yumopts.add_option('--deltarpm', action='store_true', default=False,
+        help=_('download deltas instead of full packages where possible,'
+               ' and rebuild the packages from them (needs applydeltarpm)'))
 
 
     # === <SOURCE> options ===
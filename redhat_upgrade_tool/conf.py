@@ -21,6 +21,9 @@ import os
 from tempfile import mkstemp
 from ConfigParser import *
 
+import logging
+log = logging.getLogger(__package__+".conf")
+
 class Config(RawConfigParser):
     def __init__(self, filename, defaults=None):
         RawConfigParser.__init__(self, defaults)
@@ -63,3 +66,27 @@ class Config(RawConfigParser):
         except (NoSectionError, NoOptionError):
             pass
         return value
+
+class CacheConfig(Config):
+    '''
+    A Config for the files we keep our own records in. A damaged file is
+    ignored (and we start over with an empty one) rather than raising an
+    error, option names (often paths) are case-sensitive, and failing to
+    write the file only gets a warning.
+    '''
+    def __init__(self, filename):
+        try:
+            Config.__init__(self, filename)
+        except Error as e:
+            log.warn("ignoring damaged file %s: %s", filename, e)
+            Config.__init__(self, [])
+            self.filename = filename
+
+    def optionxform(self, option):
+        return option
+
+    def write(self):
+        try:
+            Config.write(self)
+        except IOError as e:
+            log.warn("couldn't write %s: %s", self.filename, e.strerror)
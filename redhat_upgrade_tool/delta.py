@@ -0,0 +1,89 @@
+# delta.py - rebuilding packages from deltarpms
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import namedtuple
+from xml.etree.cElementTree import iterparse
+
+from .util import Popen, PIPE, STDOUT
+
+import logging
+log = logging.getLogger(__package__+".delta")
+
+applydeltarpm = '/usr/bin/applydeltarpm'
+
+class DeltaInfo(namedtuple('DeltaInfo', 'filename sequence size csum_type csum')):
+    __slots__ = ()
+
+def read_prestodelta(fileobj):
+    '''parse a prestodelta.xml file. returns a dict that maps the
+       (name, arch, epoch, version, release) of each new package to a dict
+       of {(oldepoch, oldversion, oldrelease): DeltaInfo}.'''
+    deltas = dict()
+    newpkg = None
+    for event, elem in iterparse(fileobj, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'newpackage':
+                newpkg = deltas.setdefault(tuple(elem.get(a) for a in
+                        ('name', 'arch', 'epoch', 'version', 'release')), {})
+            continue
+        if elem.tag == 'delta' and newpkg is not None:
+            csum = elem.find('checksum')
+            try:
+                info = DeltaInfo(elem.findtext('filename'),
+                                 elem.findtext('sequence'),
+                                 long(elem.findtext('size')),
+                                 csum.get('type'), csum.text)
+            except (TypeError, ValueError, AttributeError):
+                log.debug("ignoring bad delta for %s", newpkg)
+            else:
+                oldevr = tuple(elem.get(a) for a in
+                               ('oldepoch', 'oldversion', 'oldrelease'))
+                newpkg[oldevr] = info
+            elem.clear()
+        elif elem.tag == 'newpackage':
+            newpkg = None
+            elem.clear()
+    return deltas
+
+def find_delta(deltas, pkg, installed, maxsize=None):
+    '''pick the smallest delta that turns one of the installed versions
+       (a list of (epoch, version, release) tuples) into pkg, which is a
+       (name, arch, epoch, version, release) tuple. deltas that aren't
+       smaller than maxsize aren't worth it. returns None if there isn't
+       a suitable delta.'''
+    best = None
+    for evr in installed:
+        info = deltas.get(pkg, {}).get(tuple(evr))
+        if info is None or (maxsize is not None and info.size >= maxsize):
+            continue
+        if best is None or info.size < best.size:
+            best = info
+    return best
+
+def applydelta(drpm, outfile):
+    '''rebuild a package from the installed files and a deltarpm.
+       returns None if it worked, or an error message otherwise.'''
+    cmd = [applydeltarpm, drpm, outfile]
+    try:
+        proc = Popen(cmd, stdout=PIPE, stderr=STDOUT)
+        output = proc.communicate()[0]
+    except OSError as e:
+        return str(e)
+    if proc.returncode:
+        lines = output.strip().splitlines() or ['exit status %i' % proc.returncode]
+        return lines[-1]
+    return None
@@ -0,0 +1,143 @@
+# depcache.py - remember depsolving results between runs
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import hashlib
+
+from yum.transactioninfo import TransactionMember
+
+from . import depsolvecache
+from .util import save_json
+
+import logging
+log = logging.getLogger(__package__+".depcache")
+
+# bump this if the format of the cache file changes
+CACHE_VERSION = 1
+
+# txmbr.relatedto relation -> the txmbr list that holds the same packages
+related_lists = {
+    'updates': 'updates',
+    'obsoletes': 'obsoletes',
+    'updatedby': 'updated_by',
+    'obsoletedby': 'obsoleted_by',
+    'downgrades': 'downgrades',
+    'downgradedby': 'downgraded_by',
+    'dependson': 'depends_on',
+}
+
+# plain txmbr attributes that get saved and restored
+member_attrs = ('current_state', 'output_state', 'ts_state', 'reason',
+                'isDep', 'reinstall')
+
+class DepsolveCache(object):
+    '''
+    The result of the last depsolve (the transaction members and the
+    po_with_problems list), saved on disk so the next run can skip
+    depsolving entirely if nothing has changed.
+
+    Packages are stored by pkgtup, along with a flag saying whether they're
+    installed or available, and looked up again when the cache is loaded.
+    The cache is only used if its key matches: that covers the rpmdb, the
+    repomd.xml of each enabled repo, the target version and the enabled
+    plugins.
+    '''
+    def __init__(self, filename=depsolvecache):
+        self.filename = filename
+
+    def key(self, yumobj, repodata):
+        '''compute the cache key. repodata is a list of (repoid, checksum)
+           pairs for the enabled repos.'''
+        rpmdbver = yumobj.rpmdb.simpleVersion(main_only=True)[0]
+        plugins = sorted(yumobj.plugins._plugins.keys())
+        data = [CACHE_VERSION, str(rpmdbver), yumobj.version,
+                sorted(repodata), plugins]
+        return hashlib.sha256(json.dumps(data)).hexdigest()
+
+    @staticmethod
+    def _pkgref(po):
+        if po is None:
+            return None
+        return [po.repoid == 'installed', list(po.pkgtup)]
+
+    def save(self, yumobj, key):
+        '''save yumobj's current transaction under key'''
+        members = []
+        for txmbr in yumobj.tsInfo.getMembers():
+            m = dict((a, getattr(txmbr, a, None)) for a in member_attrs)
+            m['po'] = self._pkgref(txmbr.po)
+            m['relatedto'] = [(self._pkgref(po), rel)
+                              for (po, rel) in txmbr.relatedto]
+            members.append(m)
+        problems = [(self._pkgref(po1), self._pkgref(po2), err)
+                    for (po1, po2, err) in yumobj.po_with_problems]
+        data = dict(key=key, members=members, problems=problems)
+        save_json(self.filename, data, "depsolve cache")
+
+    def load(self, yumobj, key):
+        '''if the cache matches key, set up yumobj's transaction (and
+           po_with_problems) from it and return True. otherwise (or if
+           any of the packages can't be found) leave yumobj alone and
+           return False.'''
+        try:
+            with open(self.filename) as inf:
+                data = json.load(inf)
+        except (IOError, ValueError):
+            return False
+        if data.get('key') != key:
+            log.debug("depsolve cache is out of date")
+            return False
+
+        pkgs = dict()
+        def lookup(ref):
+            if ref is None:
+                return None
+            installed, tup = ref
+            tup = tuple(tup)
+            if (installed, tup) not in pkgs:
+                sack = yumobj.rpmdb if installed else yumobj.pkgSack
+                found = sack.searchPkgTuple(tup)
+                if not found:
+                    raise KeyError(tup)
+                pkgs[(installed, tup)] = found[0]
+            return pkgs[(installed, tup)]
+
+        try:
+            members = []
+            for m in data['members']:
+                txmbr = TransactionMember(lookup(m['po']))
+                for a in member_attrs:
+                    setattr(txmbr, a, m[a])
+                for ref, rel in m['relatedto']:
+                    po = lookup(ref)
+                    txmbr.relatedto.append((po, rel))
+                    lst = getattr(txmbr, related_lists.get(rel, ''), None)
+                    if lst is not None:
+                        lst.append(po)
+                members.append(txmbr)
+            problems = [(lookup(r1), lookup(r2), err)
+                        for (r1, r2, err) in data['problems']]
+        except KeyError as e:
+            log.info("package %s from depsolve cache not found", e)
+            return False
+
+        for txmbr in members:
+            txmbr.po.state = txmbr.output_state
+            yumobj.tsInfo.add(txmbr)
+        yumobj.po_with_problems = problems
+        log.info("using cached depsolve result (%u members)", len(members))
+        return True
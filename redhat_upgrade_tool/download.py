@@ -18,12 +18,25 @@
 # Author: Will Woods <wwoods@redhat.com>
 
 import os
+import time
+import rpm
 import yum
+import rpmUtils.miscutils
+import rpmUtils.transaction
 import struct
 import logging
+from itertools import izip
+from collections import namedtuple
 from .callback import BaseTsCallback
-from .treeinfo import Treeinfo, TreeinfoError
+from .treeinfo import Treeinfo, TreeinfoError, hexdigest
 from .conf import Config
+from .pkgcache import VerifyIndex, PackageCache, HeaderCache
+from .depcache import DepsolveCache
+from .precheck import SpaceEstimate, ConflictIndex, FileInfo
+from .upgrade import load_headers, conflict_problems
+from .delta import read_prestodelta, find_delta, applydelta, applydeltarpm
+from .fetch import PackageFetcher, FetchJob, verify_localpkg
+from .fetch import grab_verified, grab_conditional, warm_repos
 from yum.Errors import YumBaseError
 from yum.parser import varReplace
 from yum.constants import TS_REMOVE_STATES
@@ -39,8 +52,8 @@ disabled_plugins = ['rpm-warm-cache', 'remove-with-leaves', 'presto',
 from . import _
 from . import cachedir, upgradeconf, kernelpath, initrdpath, defaultkey
 from . import mirrormanager
-from . import packagedir
-from .util import listdir, mkdir_p, rm_rf
+from . import packagedir, MIN_AVAIL_BYTES_FOR_BOOT
+from .util import listdir, mkdir_p, rm_f, rm_rf, parallel_imap, hrsize
 from shutil import copy2
 
 log = logging.getLogger(__package__+".yum") # maybe I should rename this..
@@ -66,6 +79,79 @@ def yum_plugin_for_exc():
                 return f
     return None
 
+def repodata_checksum(repo):
+    '''checksum of the repo's current repomd.xml (or None if it's missing)'''
+    try:
+        return hexdigest(os.path.join(repo.cachedir, 'repomd.xml'), 'sha256')
+    except (IOError, OSError):
+        return None
+
+_sig_ts = (None, None)
+def checksig(filename):
+    '''check the signature of a package file. returns the result code from
+       rpmUtils.miscutils.checkSig() (0 means OK).
+       this gets run in worker processes, each of which opens its own
+       read-only transaction set (and thus its own rpm keyring).'''
+    global _sig_ts
+    pid, ts = _sig_ts
+    if pid != os.getpid():
+        ts = rpmUtils.transaction.initReadOnlyTransaction()
+        _sig_ts = (os.getpid(), ts)
+    code = rpmUtils.miscutils.checkSig(ts, filename)
+    if code == 0:
+        cache_header(ts, filename)
+    return code
+
+def cache_header(ts, filename):
+    '''put the header of a (just checked) package into the HeaderCache, so
+       the transaction test doesn't have to read it from the package again'''
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            hdr = ts.hdrFromFdno(fd)
+        finally:
+            os.close(fd)
+    except (OSError, rpm.error) as e:
+        log.debug("couldn't read header from %s: %s", filename, e)
+        return
+    HeaderCache().put(filename, st, hdr.unload())
+
+def rebuild_pkg(args):
+    '''rebuild a package from a deltarpm and check the result against the
+       package metadata. returns None if that worked, or an error message.'''
+    (drpm, local, size, csum_type, csum) = args
+    err = applydelta(drpm, local)
+    if err is None and not verify_localpkg((local, size, csum_type, csum)):
+        err = "rebuilt package doesn't match the metadata"
+    rm_f(drpm)
+    if err:
+        rm_f(local)
+    return err
+
+def header_files(hdr):
+    '''list (path, size) for each file in a package header (except ghosts)'''
+    names = hdr[rpm.RPMTAG_FILENAMES] or []
+    sizes = hdr[rpm.RPMTAG_FILESIZES] or []
+    flags = hdr[rpm.RPMTAG_FILEFLAGS] or []
+    return [(n, sz) for (n, sz, fl) in izip(names, sizes, flags)
+            if not fl & rpm.RPMFILE_GHOST]
+
+def header_fileinfo(hdr):
+    '''list (path, FileInfo) for each file in a package header (except
+       ghosts), for conflict checking'''
+    names = hdr[rpm.RPMTAG_FILENAMES] or []
+    count = len(names)
+    modes = hdr[rpm.RPMTAG_FILEMODES] or [0] * count
+    digests = hdr[rpm.RPMTAG_FILEDIGESTS] or [''] * count
+    links = hdr[rpm.RPMTAG_FILELINKTOS] or [''] * count
+    colors = hdr[rpm.RPMTAG_FILECOLORS] or [0] * count
+    flags = hdr[rpm.RPMTAG_FILEFLAGS] or [0] * count
+    return [(n, FileInfo(mode & 0xffff, digest, link, color))
+            for (n, mode, digest, link, color, fl)
+             in izip(names, modes, digests, links, colors, flags)
+            if not fl & rpm.RPMFILE_GHOST]
+
 def init_keyring(gpgdir):
     # set up gpgdir
     if not os.path.isdir(gpgdir):
@@ -85,9 +171,56 @@ def list_keyring(gpgdir):
             for k in yum.misc.return_keyids_from_pubring(gpgdir)]
 
 
+class PackageRecord(namedtuple('PackageRecord',
+                       'nevra repoid relativepath remote_url localpath '
+                       'checksum')):
+    '''
+    The few things we still need to know about a package once it has been
+    downloaded, so yum's package objects (and everything they drag along)
+    can be thrown away. It can stand in for a package object as far as
+    link_pkgs and the transaction test are concerned.
+    '''
+    __slots__ = ()
+
+    @classmethod
+    def from_po(cls, po):
+        return cls(po.nevra, po.repoid, po.relativepath, po.remote_url,
+                   po.localPkg(), tuple(po.returnIdSum()))
+
+    def localPkg(self):
+        return self.localpath
+
+    def __str__(self):
+        return self.nevra
+
+class PrefetchCallback(object):
+    '''
+    Wraps a depsolve callback, passing every package that the depsolver adds
+    to the transaction for install or update to prefetch() right away, so it
+    can start downloading while depsolving is still going on.
+    '''
+    def __init__(self, yumobj, callback, prefetch):
+        self.yumobj = yumobj
+        self.callback = callback
+        self.prefetch = prefetch
+
+    def __getattr__(self, name):
+        if self.callback is None:
+            return lambda *args, **kwargs: None
+        return getattr(self.callback, name)
+
+    def pkgAdded(self, tup, mode):
+        if hasattr(self.callback, "pkgAdded"):
+            self.callback.pkgAdded(tup, mode)
+        if mode in ('u', 'i'):
+            for txmbr in self.yumobj.tsInfo.getMembers(tup):
+                self.prefetch(txmbr.po)
+
 class UpgradeDownloader(yum.YumBase):
     '''Yum-based downloader class. Based roughly on AnacondaYum.'''
-    def __init__(self, version=None, cachedir=cachedir, cacheonly=False):
+    def __init__(self, version=None, cachedir=cachedir, cacheonly=False,
+                 workers=None, download_workers=4, mirror_workers=4,
+                 cache_quota=0, cache_max_age=None, deltarpm=False):
         # TODO: special handling for version='test' where we just synthesize
         #       a bunch of fake RPMs with interesting properties
         log.info("UpgradeDownloader(version=%s,cachedir=%s)",version,cachedir)
@@ -100,6 +233,12 @@ class UpgradeDownloader(yum.YumBase):
         if version:
             self.preconf.releasever = version
         self.cacheonly = cacheonly
+        self.workers = workers # None means one per CPU
+        self.download_workers = download_workers # per repo
+        self.mirror_workers = mirror_workers
+        self.cache_quota = cache_quota # MiB of extra packages to keep
+        self.cache_max_age = cache_max_age # days
+        self.deltarpm = deltarpm
         self.prerepoconf.cachedir = cachedir
         self.prerepoconf.cache = cacheonly
         log.debug("prerepoconf.cache=%i", self.prerepoconf.cache)
@@ -108,6 +247,8 @@ class UpgradeDownloader(yum.YumBase):
         self._treeinfo = None
         self.prerepoconf.failure_callback = raise_exception
         self._repoprogressbar = None
+        self._prefetcher = None
+        self._prefetched = dict() # localpath -> po
         # TODO: locking to prevent multiple instances
         self.verbose_logger = log
 
@@ -118,6 +259,7 @@ class UpgradeDownloader(yum.YumBase):
             # override some of yum's defaults
             conf.disable_excludes = ['all']
             conf.cache = self.cacheonly
+            # we handle deltas ourselves if asked to (see apply_deltas)
             conf.deltarpm = 0
             log.debug("conf.cache=%i", conf.cache)
         return conf
@@ -197,9 +339,18 @@ class UpgradeDownloader(yum.YumBase):
                 repo.gpgkey.append(varReplace(keyurl, self.conf.yumvar))
                 repo.gpgcheck = True
 
+        # fetch the metadata for all the enabled repos at the same time, so
+        # we don't have to wait for each one in turn below.
+        enabled = self.repos.listEnabled()
+        failed = dict()
+        if len(enabled) > 1 and not self.cacheonly:
+            failed = warm_repos(enabled, callback)
+
         # check enabled repos
-        for repo in self.repos.listEnabled():
+        for repo in enabled:
             try:
+                if repo.id in failed:
+                    raise yum.Errors.RepoError(failed[repo.id])
                 md_types = repo.repoXML.fileTypes()
             except yum.Errors.RepoError:
                 log.info("can't find valid repo metadata for %s", repo.id)
@@ -250,8 +401,30 @@ class UpgradeDownloader(yum.YumBase):
                 log.warn("couldn't write repofile for %s: %s", repo.id, str(e))
 
     # NOTE: could raise RepoError if metadata is missing/busted
-    def build_update_transaction(self, callback=None):
+    def build_update_transaction(self, callback=None, prefetch=False):
+        '''find the updates for the system. if prefetch is True, packages
+           start downloading as soon as they're added to the transaction;
+           download_packages() sorts them out afterward.
+           if neither the rpmdb nor the repos have changed since the last
+           run, the result of that run's depsolve is reused.'''
         log.info("looking for updates")
+        depcache = DepsolveCache()
+        key = depcache.key(self, [(r.id, repodata_checksum(r))
+                                  for r in self.repos.listEnabled()])
+        if not depcache.load(self, key):
+            self._build_update_transaction(callback, prefetch)
+            depcache.save(self, key)
+        return [t.po for t in self.tsInfo.getMembers()
+                     if t.ts_state in ("i", "u")]
+
+    def _build_update_transaction(self, callback=None, prefetch=False):
+        # (if we're using deltas, fetching the full packages early would
+        # defeat the purpose)
+        if prefetch and self.download_workers > 1 and not self.cacheonly \
+                and not self.deltarpm:
+            self._prefetcher = PackageFetcher(per_repo=self.download_workers,
+                                              per_mirror=self.mirror_workers)
+            callback = PrefetchCallback(self, callback, self.prefetch)
         self.dsCallback = callback
         self.update()
         (rv, msgs) = self.buildTransaction(unfinished_transactions_check=False)
@@ -261,25 +434,88 @@ class UpgradeDownloader(yum.YumBase):
             log.info("    %s", m)
         # NOTE: we ignore errors, as anaconda did before us.
         self.dsCallback = None
-        return [t.po for t in self.tsInfo.getMembers()
-                     if t.ts_state in ("i", "u")]
+
+    def prefetch(self, po):
+        '''start downloading po in the background, unless we've already got
+           (some version of) the file; download_packages() will check it.'''
+        local = po.localPkg()
+        if local in self._prefetched or os.path.exists(local) \
+                or po.remote_url.startswith("file://"):
+            return
+        log.debug("prefetching %s", po)
+        self._prefetched[local] = po
+        self._prefetcher.add(po)
+
+    def finish_prefetch(self, pkgs, index, callback=None):
+        '''wait for the downloads started while depsolving to finish.
+           packages that didn't end up in pkgs (the final transaction) are
+           removed again; the rest are recorded as verified in index.
+           returns the paths of the packages that were prefetched.'''
+        fetcher, self._prefetcher = self._prefetcher, None
+        log.info("waiting for %u prefetched packages", len(self._prefetched))
+        fetcher.callback = callback
+        fetcher.wait() # anything that failed gets fetched again later
+        wanted = set(p.localPkg() for p in pkgs)
+        for local, po in self._prefetched.iteritems():
+            if local not in wanted:
+                log.debug("removing unneeded prefetched package %s", local)
+                rm_f(local)
+                continue
+            st = getattr(po, '_verify_local_pkg_cache', None)
+            if st:
+                index.add(po.repoid, local, st)
+        fetched = wanted.intersection(self._prefetched)
+        self._prefetched.clear()
+        return fetched
+
+    def transaction_index(self):
+        '''index the transaction by pkgtup, for the reports below.
+           returns (removed, replacements): removed is the set of pkgtups
+           that are being removed (updated, obsoleted or erased), and
+           replacements maps a pkgtup to (otherpo, replaced), where replaced
+           is True if otherpo replaces the package and False if the package
+           replaces otherpo.'''
+        removed = set()
+        replacements = dict()
+        for tx in self.tsInfo.getMembers():
+            tup = tx.po.pkgtup
+            if tx.output_state in TS_REMOVE_STATES:
+                removed.add(tup)
+            if tup in replacements:
+                continue
+            # XXX multiple replacers?
+            for otherpo, rel in tx.relatedto:
+                if rel in ('obsoletedby', 'updatedby'):
+                    replacements[tup] = (otherpo, True)
+                    break
+                if rel in ('obsoletes', 'updates'):
+                    replacements[tup] = (otherpo, False)
+                    break
+        return removed, replacements
+
+    def release_packages(self):
+        '''throw away yum's package sacks, rpmdb and transaction to free up
+           memory. the repo configuration is kept.'''
+        log.info("releasing package data")
+        self._prefetched = dict()
+        del self.pkgSack
+        self.closeRpmDB()
 
     def find_packages_without_updates(self):
         '''packages on the local system that aren't being updated/obsoleted'''
-        remove = self.tsInfo.getMembersWithState(output_states=TS_REMOVE_STATES)
-        return set(p for p in self.rpmdb if p not in remove)
+        removed, replacements = self.transaction_index()
+        return set(p for p in self.rpmdb if p.pkgtup not in removed)
 
     def describe_transaction_problems(self):
         problems = []
+        removed, replacements = self.transaction_index()
 
         def find_replacement(po):
-            for tx in self.tsInfo.getMembers(po.pkgtup):
-                # XXX multiple replacers?
-                for otherpo, rel in tx.relatedto:
-                    if rel in ('obsoletedby', 'updatedby'):
-                        return po, otherpo
-                    if rel in ('obsoletes', 'updates'):
-                        return otherpo, po
+            if po.pkgtup in replacements:
+                otherpo, replaced = replacements[po.pkgtup]
+                if replaced:
+                    return po, otherpo
+                return otherpo, po
             if po in self.rpmdb:
                 return po, None
             else:
@@ -308,21 +544,243 @@ class UpgradeDownloader(yum.YumBase):
 
         return problems
 
+    def verify_localpkgs(self, pkgs, index, callback=None):
+        '''check the given (already downloaded) packages in parallel.
+           packages that were verified on a previous run (according to index)
+           are skipped, and the ones that check out OK are added to index.
+           either way, good packages get their stat() results stored in
+           po._verify_local_pkg_cache, which is where yum caches its own
+           verifyLocalPkg() results. Returns the list of bad packages.'''
+        todo, jobs, stats = [], [], []
+        for p in pkgs:
+            local = p.localPkg()
+            st = os.stat(local) # stat first in case the file changes
+            if index.is_verified(p.repoid, local, st):
+                p._verify_local_pkg_cache = st
+                continue
+            (csum_type, csum) = p.returnIdSum()
+            todo.append(p)
+            stats.append(st)
+            jobs.append((local, long(p.packagesize), csum_type, csum))
+        log.info("%u of %u local packages already verified",
+                 len(pkgs) - len(todo), len(pkgs))
+        total = len(jobs)
+        hdrcache = HeaderCache()
+        results = parallel_imap(verify_localpkg, jobs, workers=self.workers)
+        bad = []
+        for num, (p, st, ok) in enumerate(izip(todo, stats, results), 1):
+            if hasattr(callback, "verify") and callable(callback.verify):
+                callback.verify(num, total, p.localPkg(), None)
+            if ok:
+                p._verify_local_pkg_cache = st
+                index.add(p.repoid, p.localPkg(), st)
+            else:
+                log.debug("%s failed verification", p.localPkg())
+                index.discard(p.repoid, p.localPkg())
+                hdrcache.invalidate(p.localPkg())
+                bad.append(p)
+        return bad
+
+    def fetch_packages(self, pkgs, callback=None):
+        '''download the given packages using a PackageFetcher.
+           returns the list of packages that couldn't be downloaded.'''
+        if not pkgs:
+            return []
+        log.info("downloading %u packages (%u per repo, %u per mirror)",
+                 len(pkgs), self.download_workers, self.mirror_workers)
+        fetcher = PackageFetcher(per_repo=self.download_workers,
+                                 per_mirror=self.mirror_workers,
+                                 callback=callback)
+        for p in pkgs:
+            fetcher.add(p)
+        failed = fetcher.wait()
+        if failed:
+            log.info("%u packages left for yum to download", len(failed))
+        return failed
+
+    def estimate_disk_space(self, pkgs, estimate=None):
+        '''estimate how much disk space downloading and installing pkgs will
+           take on each filesystem, without downloading anything.
+           the files of the packages being removed (from the rpmdb) are
+           subtracted, and the files of the new packages are added, using
+           the headers from the HeaderCache where we have them. otherwise
+           the package's installed size is spread out like the files of the
+           package it replaces. returns a SpaceEstimate.'''
+        est = estimate or SpaceEstimate()
+        hdrcache = HeaderCache()
+        removed, replacements = self.transaction_index()
+        oldfiles = dict()
+        for po in self.rpmdb:
+            if po.pkgtup in removed:
+                oldfiles[po.pkgtup] = header_files(po.hdr)
+                est.remove_files(oldfiles[po.pkgtup])
+        download, pkgsize = 0, 0
+        for po in pkgs:
+            if po.remote_url.startswith("file://"):
+                data = None
+            else:
+                pkgsize += long(po.packagesize)
+                try:
+                    data = hdrcache.get(po.localPkg(), os.stat(po.localPkg()))
+                except OSError:
+                    data = None
+                    download += long(po.packagesize)
+            if data is not None:
+                try:
+                    est.add_files(header_files(rpm.hdr(data)))
+                    continue
+                except (rpm.error, TypeError):
+                    log.debug("bad cached header for %s", po)
+            like = ()
+            otherpo, replaced = replacements.get(po.pkgtup, (None, True))
+            if otherpo is not None and not replaced:
+                like = oldfiles.get(otherpo.pkgtup, ())
+            est.add_estimate(long(po.installedsize), like)
+        # the packages get downloaded into cachedir, then linked (or copied,
+        # if it's on another filesystem) into packagedir
+        est.add(cachedir, download)
+        if est.mount_for(cachedir) != est.mount_for(packagedir):
+            est.add(packagedir, pkgsize)
+        # the new kernel's files are already counted; the reserve is for
+        # them plus the initramfs that gets built for it, same as the check
+        # after prep_boot
+        est.reserve('/boot', MIN_AVAIL_BYTES_FOR_BOOT)
+        return est
+
+    def find_file_conflicts(self, pkgs):
+        '''look for file conflicts between the (downloaded) packages in pkgs
+           and the installed packages that aren't being removed, and among
+           pkgs themselves. returns a list of problems, like the ones the
+           test transaction would report.'''
+        log.info("checking for file conflicts")
+        index = ConflictIndex()
+        paths = [p.localPkg() for p in pkgs]
+        for po, (path, hdr, err) in izip(pkgs, load_headers(paths,
+                                            workers=self.workers,
+                                            hdrcache=HeaderCache())):
+            if hdr is None:
+                log.debug("can't check %s for conflicts: %s", path, err)
+                continue
+            index.add_new(str(po), header_fileinfo(hdr))
+        removed, replacements = self.transaction_index()
+        for po in self.rpmdb:
+            if po.pkgtup not in removed:
+                index.check_installed(str(po), header_fileinfo(po.hdr))
+        log.info("found %u file conflicts", len(index.conflicts))
+        return conflict_problems(index.conflicts)
+
+    def read_deltas(self, repo):
+        '''get the deltas the repo has to offer (see read_prestodelta)'''
+        try:
+            fn = repo.retrieveMD('prestodelta')
+        except yum.Errors.RepoError:
+            log.debug("no deltas available for %s", repo.id)
+            return {}
+        try:
+            if fn.endswith('.gz'):
+                fileobj = GzipFile(fn)
+            else:
+                fileobj = open(fn)
+            try:
+                return read_prestodelta(fileobj)
+            finally:
+                fileobj.close()
+        except (IOError, SyntaxError) as e:
+            log.info("couldn't read deltas for %s: %s", repo.id, e)
+            return {}
+
+    def apply_deltas(self, pkgs, index, callback=None):
+        '''download deltarpms for the given packages, where the repos have
+           them, and rebuild the packages from the deltas and the installed
+           files, using several worker threads. packages that get rebuilt
+           OK are added to index. returns the packages that still need to be
+           downloaded in full.'''
+        if not os.path.exists(applydeltarpm):
+            log.warn("%s not found, not using deltas", applydeltarpm)
+            return pkgs
+        repodeltas = dict()
+        fetcher = PackageFetcher(per_repo=self.download_workers,
+                                 per_mirror=self.mirror_workers,
+                                 callback=callback)
+        jobs = dict() # job -> po
+        saved = 0
+        for p in pkgs:
+            if p.repo.id not in repodeltas:
+                repodeltas[p.repo.id] = self.read_deltas(p.repo)
+            installed = [(i.epoch, i.version, i.release) for i in
+                         self.rpmdb.searchNevra(name=p.name, arch=p.arch)]
+            info = find_delta(repodeltas[p.repo.id],
+                              (p.name, p.arch, p.epoch, p.version, p.release),
+                              installed, maxsize=long(p.packagesize))
+            if info is None:
+                continue
+            drpm = os.path.join(p.repo.cachedir, 'deltas',
+                                os.path.basename(info.filename))
+            job = FetchJob(info.filename, drpm, info.size,
+                           info.csum_type, info.csum)
+            jobs[job] = p
+            saved += long(p.packagesize) - info.size
+            fetcher.add_job(p.repo, job)
+        if not jobs:
+            return pkgs
+        log.info("downloading %u deltas (saving %s)", len(jobs), hrsize(saved))
+        for job in fetcher.wait():
+            log.info("couldn't download delta for %s", jobs.pop(job))
+            rm_f(job.local)
+        todo = jobs.items()
+        args = []
+        for job, p in todo:
+            (csum_type, csum) = p.returnIdSum()
+            args.append((job.local, p.localPkg(), long(p.packagesize),
+                         csum_type, csum))
+        rebuilt = set()
+        results = parallel_imap(rebuild_pkg, args, workers=self.workers,
+                                threads=True)
+        for (job, p), err in izip(todo, results):
+            if err:
+                log.info("couldn't rebuild %s from delta: %s", p, err)
+                continue
+            st = os.stat(p.localPkg())
+            p._verify_local_pkg_cache = st
+            index.add(p.repoid, p.localPkg(), st)
+            rebuilt.add(p.localPkg())
+        log.info("rebuilt %u of %u packages from deltas",
+                 len(rebuilt), len(pkgs))
+        return [p for p in pkgs if p.localPkg() not in rebuilt]
+
     def download_packages(self, pkgs, callback=None):
         # Verifying a full upgrade payload of ~2000 pkgs takes a good 90-120
         # seconds with no callback. Unacceptable!
-        # So: here we have our own verifyPkg loop, with callback.
-        # The results get cached, so when yum does it again in the real
-        # _downloadPackages function it's a negligible delay.
+        # So: here we check the local files ourselves (in parallel, with
+        # callback), skipping the ones that were already checked on a
+        # previous run. The results go into yum's verification cache, so
+        # when yum does it again in the real _downloadPackages function it's
+        # a negligible delay. Bad files get re-downloaded by yum as usual.
+        index = VerifyIndex()
+        for repo in set(p.repo for p in pkgs):
+            index.check_repo(repo.id, repodata_checksum(repo))
+        prefetched = set()
+        if self._prefetcher:
+            prefetched = self.finish_prefetch(pkgs, index, callback)
         localpkgs = [p for p in pkgs if os.path.exists(p.localPkg())]
-        total = len(localpkgs)
-        # XXX: multithreading?
-        for num, p in enumerate(localpkgs, 1):
-            local = p.localPkg()
-            if hasattr(callback, "verify") and callable(callback.verify):
-                callback.verify(num, total, local, None)
-            ok = self.verifyPkg(local, p, False) # result will be cached by yum
+        bad = self.verify_localpkgs(localpkgs, index, callback)
+        log.info("%u of %u local packages verified OK",
+                 len(localpkgs) - len(bad), len(localpkgs))
+        good = set(p.localPkg() for p in localpkgs)
+        good.difference_update(p.localPkg() for p in bad)
+        todo = [p for p in pkgs if not p.remote_url.startswith("file://")
+                and p.localPkg() not in good]
+        # packages that were already in the cache when we got here are hits
+        cache = PackageCache()
+        cache.record(hits=len(good.difference(prefetched)),
+                     misses=len(todo) + len(prefetched))
+        cache.write()
+        if self.deltarpm and todo:
+            todo = self.apply_deltas(todo, index, callback)
         log.info("beginning package download...")
+        if self.download_workers > 1:
+            # fetch the rest in parallel; yum will pick up anything we missed
+            self.fetch_packages(todo, callback)
         updates = self._downloadPackages(callback)
 
         # Handle _downloadPackages returning None instead of an empty list
@@ -335,6 +793,12 @@ class UpgradeDownloader(yum.YumBase):
                 log.debug("  -%s", p)
             for p in set(updates).difference(pkgs):
                 log.debug("  +%s", p)
+        # remember the packages yum just downloaded and verified
+        for p in updates:
+            st = getattr(p, '_verify_local_pkg_cache', None)
+            if st:
+                index.add(p.repoid, p.localPkg(), st)
+        index.write()
         # check signatures of downloaded packages
         if updates:
             self._checkSignatures(updates, callback)
@@ -381,16 +845,40 @@ class UpgradeDownloader(yum.YumBase):
             log.info("Downloaded product cert %s: %s %s" % (product.id, product.name, cert.path))
 
     def clean_cache(self, keepfiles):
+        '''remove unneeded rpms from the cache. the ones in keepfiles are
+           always kept; of the rest, the ones that haven't been used for
+           cache_max_age days are removed, and then the least recently used
+           ones until the packages that aren't in keepfiles fit in
+           cache_quota MiB.'''
         log.info("checking for unneeded rpms in cache")
+        keepfiles = set(keepfiles)
         # Find all the packages in the caches (not on media though)
         localpkgs = set(f for r in self.repos.listEnabled() if not r.mediaid
                           for f in listdir(r.pkgdir) if f.endswith(".rpm"))
-        for f in localpkgs.difference(keepfiles):
+        files = dict()
+        for f in localpkgs:
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            files[f] = (st.st_size, st.st_mtime)
+        cache = PackageCache()
+        hdrcache = HeaderCache()
+        now = time.time()
+        for f in keepfiles:
+            cache.touch(f, now)
+        max_age = None
+        if self.cache_max_age is not None:
+            max_age = self.cache_max_age * 24*60*60
+        for f in cache.evict(files, keepfiles, self.cache_quota * 2**20,
+                             max_age, now):
             try:
                 log.debug("removing %s", f)
                 os.remove(f)
-            except IOError as e:
+            except (IOError, OSError) as e:
                 log.info("failed to remove %s", f)
+            hdrcache.invalidate(f)
+        cache.write()
         # TODO remove dirs that don't belong to any repo
 
     @property
@@ -408,15 +896,16 @@ class UpgradeDownloader(yum.YumBase):
             else:
                 log.debug("fetching .treeinfo from repo '%s'",
                           self.instrepo.urls[0])
-                if os.path.exists(outfile):
-                    os.remove(outfile)
+                # if we have a copy from last time, only fetch it again if
+                # it's changed on the server
+                source = ' '.join(self.instrepo.urls)
                 try:
-                    fn = self.instrepo.grab.urlgrab('.treeinfo', outfile,
-                                                    reget=None)
+                    fn = grab_conditional(self.instrepo.grab, '.treeinfo',
+                                          outfile, source)
                 except Exception:
                     try:
-                        fn = self.instrepo.grab.urlgrab('treeinfo', outfile,
-                                                        reget=None)
+                        fn = grab_conditional(self.instrepo.grab, 'treeinfo',
+                                              outfile, source)
                     except Exception as e:
                         log.error("Error downloading .treeinfo or treeinfo"
                                   " from repo %s: %s"
@@ -428,29 +917,54 @@ class UpgradeDownloader(yum.YumBase):
         return self._treeinfo
 
     def download_boot_images(self, arch=None):
+        # remember which images we've already checked, so they don't need
+        # to be hashed again on the next run
+        index = VerifyIndex()
+
+        def image_ok(section, relpath, outpath):
+            try:
+                st = os.stat(outpath)
+            except OSError:
+                return False
+            if index.is_verified(section, outpath, st):
+                return True
+            if self.treeinfo.checkfile(outpath, relpath):
+                index.add(section, outpath, st)
+                return True
+            return False
+
         # helper function to grab and checksum image files listed in .treeinfo
         def grab_and_check(imgarch, imgtype, outpath):
             relpath = self.treeinfo.get_image(imgarch, imgtype)
             log.debug("grabbing %s %s", imgarch, imgtype)
             log.info("downloading %s to %s", relpath, outpath)
-            if self.treeinfo.checkfile(outpath, relpath):
+            algo, checksum = self.treeinfo.checksum(relpath)
+            section = 'image:' + relpath
+            index.check_repo(section, algo + ':' + checksum)
+            if image_ok(section, relpath, outpath):
                 log.debug("file already exists and checksum OK")
                 return outpath
-            def checkfile(cb):
-                log.debug("checking %s", relpath)
-                if not self.treeinfo.checkfile(cb.filename, relpath):
-                    log.info("checksum doesn't match - retrying")
-                    raise yum.URLGrabError(-1)
-            return self.instrepo.grab.urlgrab(relpath, outpath,
-                                              checkfunc=checkfile,
-                                              reget=None,
-                                              copy_local=True)
+            # the checksum gets computed while downloading, and interrupted
+            # downloads get resumed
+            fn = grab_verified(self.instrepo.grab, relpath, outpath,
+                               algo, checksum)
+            index.add(section, fn, os.stat(fn))
+            return fn
 
         # download the images
         try:
             if not arch:
                 arch = self.treeinfo.get('general', 'arch')
-            kernel = grab_and_check(arch, 'kernel', kernelpath)
+            # download the kernel into the cache too, so unfinished
+            # downloads (and their journals) don't pile up in /boot
+            cachekernel = os.path.join(cachedir, os.path.basename(kernelpath))
+            kernel = grab_and_check(arch, 'kernel', cachekernel)
+            try:
+                copy2(kernel, kernelpath)
+            except IOError as e:
+                print _("Copying kernel to '%s' failed:\n%s") % (kernelpath, e)
+                raise SystemExit(1)
+            kernel = kernelpath
             # cache the initrd somewhere so we don't have to fetch it again
             # if it gets modified later.
             cacheinitrd = os.path.join(cachedir, os.path.basename(initrdpath))
@@ -479,6 +993,8 @@ class UpgradeDownloader(yum.YumBase):
                 # The exception actually was a KeyBoardInterrupt, re-raise it
                 raise
 
+        index.write()
+
         # Save kernel/initrd info so we can clean it up later
         with Config(upgradeconf) as conf:
             conf.set("boot", "kernel", kernel)
@@ -489,8 +1005,19 @@ class UpgradeDownloader(yum.YumBase):
     def _checkSignatures(self, pkgs, callback):
         '''check the package signatures and get keys if needed.
            works like YumBase._checkSignatures() except it only uses our
-           special automatic _GPGKeyCheck to import untrusted keys.'''
-        for po in pkgs:
+           special automatic _GPGKeyCheck to import untrusted keys.
+           The signatures get checked by worker processes first; packages
+           that don't pass are then checked again (and have their keys
+           imported) one at a time, in order, so the first bad package is
+           always the one that gets reported.'''
+        if self._override_sigchecks:
+            presigned = [None] * len(pkgs)
+        else:
+            presigned = parallel_imap(checksig, [po.localPkg() for po in pkgs],
+                                      workers=self.workers)
+        for po, sigresult in izip(pkgs, presigned):
+            if sigresult == 0:
+                continue
             result, errmsg = self.sigCheckPkg(po)
             if result == 0:
                 continue
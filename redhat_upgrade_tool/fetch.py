@@ -0,0 +1,490 @@
+# fetch.py - concurrent and resumable downloads for UpgradeDownloader
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import signal
+import shutil
+import hashlib
+import multiprocessing
+from collections import namedtuple
+from Queue import Empty
+
+import yum
+from urlgrabber.grabber import URLGrabError
+
+from . import _
+from .conf import CacheConfig
+from .util import mkdir_p, rm_f
+
+import logging
+log = logging.getLogger(__package__+".fetch")
+
+# everything a worker process needs to know to download a package
+FetchJob = namedtuple('FetchJob', 'relpath local size csum_type csum')
+
+def verify_localpkg(args):
+    '''check a local package file against its expected size and checksum.
+       this gets run in a worker process, so it only deals in plain data.'''
+    (filename, size, csum_type, csum) = args
+    try:
+        if os.path.getsize(filename) != size:
+            return False
+        return yum.misc.checksum(csum_type, filename, datasize=size) == csum
+    except (OSError, yum.Errors.MiscError):
+        return False
+
+def checkjob(obj, job):
+    '''urlgrabber checkfunc: make sure we got the file we expected'''
+    if not verify_localpkg((obj.filename, job.size, job.csum_type, job.csum)):
+        raise URLGrabError(-1, _("Package does not match intended download"))
+
+def fetch_job(repo, mirror, job):
+    '''download a single package, from the given mirror if possible'''
+    mkdir_p(os.path.dirname(job.local))
+    opts = dict(checkfunc=(checkjob, (job,), {}), progress_obj=None)
+    try:
+        url = mirror.rstrip('/') + '/' + job.relpath
+        return repo.grabfunc.urlgrab(url, job.local, **opts)
+    except URLGrabError as e:
+        log.debug("%s: %s - trying other mirrors", job.relpath, e)
+    return repo.grab.urlgrab(job.relpath, job.local, **opts)
+
+def fetch_worker(repo, mirror, jobs, results):
+    '''worker process main loop: fetch jobs from the queue until we get None,
+       and put (localpath, errmsg) on the results queue for each one.'''
+    # let the parent handle ^C; it'll terminate us if needed
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        try:
+            fetch_job(repo, mirror, job)
+            err = None
+        except (URLGrabError, IOError, OSError) as e:
+            err = str(e)
+        results.put((job.local, err))
+
+class PackageFetcher(object):
+    '''
+    Download packages using several worker processes at once.
+
+    Each repo gets up to per_repo workers, and each of the repo's mirrors gets
+    at most per_mirror of those. A worker sticks to one mirror for all of its
+    jobs, so it keeps reusing the same connection (each worker process has
+    its own urlgrabber handle), and falls back to yum's normal mirror
+    failover only if that mirror fails.
+
+    Packages are written to po.localPkg() and checked against the checksum
+    in the repo metadata, just like yum would do it. Packages that couldn't
+    be fetched are left for yum's _downloadPackages to deal with.
+    '''
+    def __init__(self, per_repo=4, per_mirror=4, callback=None):
+        self.per_repo = max(1, per_repo)
+        self.per_mirror = max(1, per_mirror)
+        self.callback = callback
+        self.results = multiprocessing.Queue()
+        self._queues = dict()  # repoid -> job queue
+        self._queued = dict()  # repoid -> number of jobs
+        self._workers = dict() # repoid -> list of worker processes
+        self._pending = dict() # localpath -> po (or other item)
+        self.total = 0
+
+    def _start_worker(self, repo):
+        workers = self._workers.setdefault(repo.id, [])
+        mirrors = repo.urls
+        limit = min(self.per_repo, self.per_mirror * len(mirrors))
+        if len(workers) >= min(limit, self._queued[repo.id]):
+            return
+        mirror = mirrors[len(workers) % len(mirrors)]
+        log.debug("starting worker #%u for %s (%s)",
+                  len(workers)+1, repo.id, mirror)
+        w = multiprocessing.Process(target=fetch_worker,
+                                    name="fetch-%s-%u" % (repo.id, len(workers)),
+                                    args=(repo, mirror, self._queues[repo.id],
+                                          self.results))
+        w.daemon = True
+        w.start()
+        workers.append(w)
+
+    def add(self, po):
+        '''queue a package for download. workers are started as needed.'''
+        (csum_type, csum) = po.returnIdSum()
+        job = FetchJob(po.relativepath, po.localPkg(), long(po.packagesize),
+                       csum_type, csum)
+        self.add_job(po.repo, job, po)
+
+    def add_job(self, repo, job, item=None):
+        '''queue a download from repo, described by a FetchJob. wait()
+           reports failures in terms of item (the job itself by default).
+           if item is a package object, yum's verification cache gets
+           set for it.'''
+        if job.local in self._pending or not repo.urls:
+            return
+        if repo.id not in self._queues:
+            self._queues[repo.id] = multiprocessing.Queue()
+            self._queued[repo.id] = 0
+        self._queues[repo.id].put(job)
+        self._queued[repo.id] += 1
+        self._pending[job.local] = job if item is None else item
+        self.total += 1
+        self._start_worker(repo)
+
+    def _alive(self):
+        return any(w.is_alive() for ws in self._workers.values() for w in ws)
+
+    def wait(self):
+        '''wait for all the queued downloads to finish.
+           returns the list of packages (or other items) that couldn't be
+           downloaded.'''
+        for repoid, workers in self._workers.items():
+            for w in workers:
+                self._queues[repoid].put(None)
+        failed = []
+        num = self.total - len(self._pending)
+        try:
+            while self._pending:
+                try:
+                    local, err = self.results.get(timeout=1)
+                except Empty:
+                    if self._alive():
+                        continue
+                    log.warn("download workers exited unexpectedly")
+                    failed.extend(self._pending.values())
+                    break
+                po = self._pending.pop(local)
+                num += 1
+                if err:
+                    log.info("couldn't download %s: %s", po, err)
+                    failed.append(po)
+                elif hasattr(po, 'localPkg'):
+                    # yum keeps its verifyLocalPkg() results here
+                    po._verify_local_pkg_cache = os.stat(local)
+                if hasattr(self.callback, "fetch"):
+                    self.callback.fetch(num, self.total, local, err)
+        finally:
+            for workers in self._workers.values():
+                for w in workers:
+                    if self._pending:
+                        w.terminate()
+                    w.join()
+            self._queues.clear()
+            self._queued.clear()
+            self._workers.clear()
+            self._pending.clear()
+            self.total = 0
+        return failed
+
+def warm_repo(repo, results):
+    '''worker process: fetch and check the repomd and primary metadata for
+       repo, so it's already in the cache when yum wants it.
+       puts (repoid, errmsg) on the results queue; errmsg is only set if the
+       repomd couldn't be loaded.'''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # don't have all the workers drawing progress bars over each other
+    repo.setCallback(None)
+    try:
+        md_types = repo.repoXML.fileTypes()
+    except yum.Errors.RepoError as e:
+        results.put((repo.id, str(e)))
+        return
+    mdtype = 'primary_db' if 'primary_db' in md_types else 'primary'
+    try:
+        repo.retrieveMD(mdtype)
+    except yum.Errors.RepoError as e:
+        # yum will try again (and complain properly) when it needs it
+        log.debug("%s: couldn't fetch %s: %s", repo.id, mdtype, e)
+    results.put((repo.id, None))
+
+def warm_repos(repos, callback=None):
+    '''fetch the metadata for all the given repos at once, with one worker
+       process per repo. progress goes to callback.progressbar().
+       returns a dict of {repoid: errmsg} for the repos whose repomd
+       couldn't be loaded.'''
+    results = multiprocessing.Queue()
+    workers = []
+    for repo in repos:
+        w = multiprocessing.Process(target=warm_repo,
+                                    name="repodata-%s" % repo.id,
+                                    args=(repo, results))
+        w.daemon = True
+        w.start()
+        workers.append(w)
+    failed = dict()
+    done = 0
+    try:
+        while done < len(workers):
+            try:
+                repoid, err = results.get(timeout=1)
+            except Empty:
+                if any(w.is_alive() for w in workers):
+                    continue
+                log.warn("metadata workers exited unexpectedly")
+                break
+            done += 1
+            if err:
+                failed[repoid] = err
+            if hasattr(callback, "progressbar"):
+                callback.progressbar(done, len(workers), repoid)
+    finally:
+        for w in workers:
+            if done < len(workers):
+                w.terminate()
+            w.join()
+    return failed
+
+class DownloadJournal(CacheConfig):
+    '''
+    Notes about a download, kept in outpath.journal, so an interrupted
+    download can pick up where it stopped instead of starting over.
+
+    'key' says what's being downloaded; if it doesn't match, the rest of the
+    journal is meaningless. 'received' is the number of bytes of outpath.part
+    known to be on disk and 'digest' is the checksum of those bytes. (The
+    hasher's state can't be saved, so it gets rebuilt by reading back the
+    partial file, which has to produce the same digest.) 'etag' and
+    'modified' are the validators the server sent with the data.
+    '''
+    section = 'download'
+
+    def __init__(self, outpath):
+        CacheConfig.__init__(self, outpath + '.journal')
+
+    def _get(self, option):
+        return self.get(self.section, option)
+
+    @property
+    def key(self):
+        return self._get('key')
+
+    @property
+    def received(self):
+        try:
+            return int(self._get('received') or 0)
+        except ValueError:
+            return 0
+
+    @property
+    def digest(self):
+        return self._get('digest')
+
+    def reset(self, key):
+        '''start a new journal for the download identified by key'''
+        self.remove_section(self.section)
+        self.set(self.section, 'key', key)
+
+    def checkpoint(self, received, hasher):
+        '''record that the first 'received' bytes are safely on disk'''
+        self.set(self.section, 'received', received)
+        self.set(self.section, 'digest', hasher.hexdigest())
+        self.write()
+
+    def validators(self):
+        return (self._get('etag'), self._get('modified'))
+
+    def set_validators(self, fo):
+        for option, header in (('etag', 'ETag'), ('modified', 'Last-Modified')):
+            value = response_header(fo, header)
+            if value:
+                self.set(self.section, option, value)
+
+    def same_validators(self, fo):
+        '''False if the server says the file has changed since the journal
+           was written. (Servers that don't send validators get the benefit
+           of the doubt; the final checksum catches any mixups.)'''
+        new = (response_header(fo, 'ETag'), response_header(fo, 'Last-Modified'))
+        for old, cur in zip(self.validators(), new):
+            if old and cur and old != cur:
+                return False
+        return True
+
+    def request_headers(self):
+        '''headers for a conditional request for the journaled file'''
+        (etag, modified) = self.validators()
+        headers = []
+        if etag:
+            headers.append(('If-None-Match', etag))
+        if modified:
+            headers.append(('If-Modified-Since', modified))
+        return tuple(headers)
+
+    def remove(self):
+        rm_f(self.filename)
+
+def response_header(fo, name):
+    '''get a header from a urlgrabber response, or None'''
+    try:
+        return fo.info().getheader(name)
+    except AttributeError:
+        return None
+
+def not_modified(fo):
+    '''did the server answer a conditional request with 304 Not Modified?'''
+    return getattr(fo, 'http_code', None) == 304
+
+def range_not_satisfiable(e):
+    '''is e the server refusing the range we asked for? (urlgrabber calls
+       that error 9, or passes on the HTTP 416.)'''
+    if not isinstance(e, URLGrabError):
+        return False
+    return e.errno == 9 or getattr(e, 'code', None) == 416
+
+def resume_partial(partfile, journal, algo, blocksize=256*1024):
+    '''work out how much of partfile can be kept, according to journal.
+       returns (offset, hasher), where hasher has already been fed the first
+       'offset' bytes of partfile.'''
+    hasher = hashlib.new(algo)
+    received = journal.received
+    if not received:
+        return 0, hasher
+    left = received
+    try:
+        with open(partfile, 'rb') as inf:
+            while left:
+                data = inf.read(min(blocksize, left))
+                if not data:
+                    break
+                hasher.update(data)
+                left -= len(data)
+    except IOError:
+        pass
+    if not left and hasher.hexdigest() == journal.digest:
+        return received, hasher
+    log.info("partial download %s doesn't match its journal - discarding it",
+             partfile)
+    return 0, hashlib.new(algo)
+
+def grab_verified(grab, relpath, outpath, algo, checksum, retries=3,
+                  blocksize=256*1024, checkpoint=4*2**20):
+    '''download relpath to outpath with the given urlgrabber object (e.g.
+       repo.grab), computing its checksum while the data arrives, so the file
+       never needs to be read back to check it.
+       the data is written to outpath.part and only renamed into place when
+       the checksum matches. progress is recorded in a DownloadJournal every
+       'checkpoint' bytes (and whenever the transfer stops), so if the
+       connection drops - or the whole program gets interrupted - the next
+       attempt asks the server for the rest of the file instead of starting
+       over. if the journal says we already have the whole file, it's just
+       checked and renamed; if the server won't send anything past what we
+       have, the download is started over. on a mismatch the download is
+       started over, up to 'retries' times, after which URLGrabError is
+       raised.'''
+    partfile = outpath + '.part'
+    journal = DownloadJournal(outpath)
+    key = "%s %s:%s" % (relpath, algo, checksum)
+    if journal.key != key:
+        journal.reset(key)
+    def finish():
+        os.rename(partfile, outpath)
+        journal.remove()
+        return outpath
+    for attempt in range(retries):
+        offset, hasher = resume_partial(partfile, journal, algo, blocksize)
+        if offset and hasher.hexdigest() == checksum:
+            # we got all of it last time, but didn't get to rename it
+            log.info("partial download of %s is complete", relpath)
+            return finish()
+        opts = dict()
+        if offset:
+            log.info("resuming download of %s at byte %u", relpath, offset)
+            opts['range'] = (offset, None)
+        else:
+            journal.reset(key)
+        fo = None
+        try:
+            fo = grab.urlopen(relpath, **opts)
+            if offset and not journal.same_validators(fo):
+                log.info("%s changed on the server - starting over", relpath)
+                journal.reset(key)
+                continue
+            journal.set_validators(fo)
+            received = saved = offset
+            with open(partfile, 'r+b' if offset else 'wb') as outf:
+                outf.seek(offset)
+                outf.truncate()
+                try:
+                    while True:
+                        data = fo.read(blocksize)
+                        if not data:
+                            break
+                        hasher.update(data)
+                        outf.write(data)
+                        received += len(data)
+                        if received - saved >= checkpoint:
+                            outf.flush()
+                            journal.checkpoint(received, hasher)
+                            saved = received
+                finally:
+                    outf.flush()
+                    journal.checkpoint(received, hasher)
+        except (URLGrabError, IOError) as e:
+            if offset and range_not_satisfiable(e):
+                # there's nothing past the end of what we have, but it
+                # doesn't match - so what we have is no good
+                log.info("can't resume download of %s - starting over",
+                         relpath)
+                journal.reset(key)
+                continue
+            if attempt == retries-1:
+                raise
+            log.info("download of %s interrupted: %s - retrying", relpath, e)
+            continue
+        finally:
+            if fo is not None:
+                fo.close()
+        if hasher.hexdigest() == checksum:
+            return finish()
+        log.info("checksum for %s doesn't match - retrying", relpath)
+        journal.reset(key)
+    journal.remove()
+    rm_f(partfile)
+    raise URLGrabError(-1, _("checksum doesn't match for %s") % relpath)
+
+def grab_conditional(grab, relpath, outpath, source=None):
+    '''download relpath to outpath, unless the copy of it we already have is
+       still current.
+       the ETag/Last-Modified the server sent are kept in a DownloadJournal
+       next to outpath, and used to make a conditional request the next time
+       around; if the server says the file hasn't changed, the existing copy
+       is kept. 'source' identifies where the file comes from (e.g. the repo
+       urls), so a copy from somewhere else never gets reused.'''
+    journal = DownloadJournal(outpath)
+    key = "%s %s" % (relpath, source)
+    headers = ()
+    if os.path.exists(outpath) and journal.key == key:
+        headers = journal.request_headers()
+    try:
+        fo = grab.urlopen(relpath, http_headers=headers)
+    except URLGrabError as e:
+        if headers and getattr(e, 'code', None) == 304:
+            log.debug("%s not modified, keeping %s", relpath, outpath)
+            return outpath
+        raise
+    partfile = outpath + '.part'
+    try:
+        if headers and not_modified(fo):
+            log.debug("%s not modified, keeping %s", relpath, outpath)
+            return outpath
+        journal.reset(key)
+        journal.set_validators(fo)
+        with open(partfile, 'wb') as outf:
+            shutil.copyfileobj(fo, outf)
+    finally:
+        fo.close()
+    os.rename(partfile, outpath)
+    journal.write()
+    return outpath
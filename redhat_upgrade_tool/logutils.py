@@ -17,7 +17,13 @@
 #
 # Author: Will Woods <wwoods@redhat.com>
 
+import os
+import errno
+import fcntl
 import logging
+from select import select, error as SelectError
+from threading import Thread, Condition
+from collections import deque
 
 class CompatNullHandler(logging.Handler):
     def emit(self, record):
@@ -71,3 +77,115 @@ def consolelog(level=logging.WARNING, loggername=__package__, tty=None):
     if level < logger.getEffectiveLevel():
         logger.setLevel(level)
     logger.addHandler(h)
+
+class PipeLogger(object):
+    '''
+    Log the lines written to an anonymous pipe, without ever making the
+    writer wait on the logging.
+
+    A reader thread drains the pipe as soon as there's data and puts the
+    complete lines in a bounded buffer; a writer thread takes them out in
+    batches and passes them to the logger. If the buffer fills up, the
+    oldest lines are dropped (and counted) instead. Runs of identical lines
+    are logged once, followed by a count.
+    Lines starting with 'D: ' (rpm's debug messages) are logged at DEBUG.
+    '''
+    def __init__(self, logger, level=logging.INFO, maxlines=10000):
+        self.logger = logger
+        self.level = level
+        self.maxlines = maxlines
+        self.lines = deque(maxlen=maxlines)
+        self.dropped = 0
+        self._cond = Condition()
+        self._eof = False
+        self._last = None
+        self._repeats = 0
+        rfd, wfd = os.pipe()
+        fcntl.fcntl(rfd, fcntl.F_SETFL,
+                    fcntl.fcntl(rfd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        fcntl.fcntl(rfd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self._rfd = rfd
+        self.pipe = os.fdopen(wfd, 'w')
+        self._threads = [Thread(target=self._read, name='pipelogger-read'),
+                         Thread(target=self._write, name='pipelogger-write')]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def fileno(self):
+        return self.pipe.fileno()
+
+    def close(self, timeout=5):
+        '''close the pipe and wait (a while) for the remaining lines to be
+           logged. anything else holding the pipe open (like a leftover
+           scriptlet process) will keep the threads running after that.'''
+        self.pipe.close()
+        for t in self._threads:
+            t.join(timeout)
+
+    def _read(self):
+        partial = ''
+        while True:
+            try:
+                select([self._rfd], [], [])
+                data = os.read(self._rfd, 65536)
+            except SelectError:
+                continue
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if not data:
+                break
+            lines = (partial + data).split('\n')
+            partial = lines.pop()
+            self._queue(lines)
+        if partial:
+            self._queue([partial])
+        os.close(self._rfd)
+        with self._cond:
+            self._eof = True
+            self._cond.notify()
+
+    def _queue(self, lines):
+        with self._cond:
+            for line in lines:
+                if len(self.lines) == self.maxlines:
+                    self.dropped += 1
+                self.lines.append(line)
+            self._cond.notify()
+
+    def _write(self):
+        while True:
+            with self._cond:
+                while not self.lines and not self._eof:
+                    self._cond.wait()
+                batch = list(self.lines)
+                self.lines.clear()
+                dropped, self.dropped = self.dropped, 0
+                eof = self._eof
+            if dropped:
+                self._flush_repeats()
+                self.logger.warning("(%u lines of output dropped)", dropped)
+            for line in batch:
+                self._emit(line)
+            if eof:
+                break
+        self._flush_repeats()
+
+    def _emit(self, line):
+        if line == self._last:
+            self._repeats += 1
+            return
+        self._flush_repeats()
+        self._last = line
+        if line.startswith('D: '):
+            self.logger.debug(line[3:].rstrip())
+        else:
+            self.logger.log(self.level, line.rstrip())
+
+    def _flush_repeats(self):
+        if self._repeats:
+            self.logger.log(self.level, "(last line repeated %u more times)",
+                            self._repeats)
+            self._repeats = 0
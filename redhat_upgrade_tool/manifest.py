@@ -0,0 +1,143 @@
+# manifest.py - checksummed list of the packages staged for the upgrade
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+The manifest lists each entry of package.list along with the size, mtime
+and checksum of its file, one tab-separated line per entry:
+
+    name    size    mtime   algo:digest
+
+The checksum is the one from the repo metadata, which the package was
+already checked against when it was downloaded, so writing the manifest
+doesn't need to read the packages.
+
+To check the packages (e.g. from the upgrade environment), run:
+
+    python -m redhat_upgrade_tool.manifest [--full] [MANIFEST [BASEDIR]]
+'''
+
+import os
+import sys
+import hashlib
+from collections import namedtuple
+from itertools import izip
+
+from . import packagedir, packagemanifest
+from .util import parallel_imap
+
+import logging
+log = logging.getLogger(__package__+".manifest")
+
+# yum calls sha1 'sha'
+algo_names = {'sha': 'sha1'}
+
+class ManifestEntry(namedtuple('ManifestEntry', 'name size mtime algo digest')):
+    __slots__ = ()
+
+    def format(self):
+        return "%s\t%u\t%u\t%s:%s\n" % (self.name, self.size, self.mtime,
+                                        self.algo, self.digest)
+
+    @classmethod
+    def parse(cls, line):
+        name, size, mtime, csum = line.rstrip('\n').split('\t')
+        algo, digest = csum.split(':', 1)
+        return cls(name, int(size), int(mtime), algo, digest)
+
+def write_manifest(entries, filename=packagemanifest):
+    '''write the manifest. entries is a list of (name, path, (algo, digest))
+       where name is the package.list entry and path is where the file is
+       right now.'''
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as outf:
+        for name, path, (algo, digest) in entries:
+            st = os.stat(path)
+            entry = ManifestEntry(name, st.st_size, int(st.st_mtime),
+                                  algo_names.get(algo, algo), digest)
+            outf.write(entry.format())
+    os.rename(tmp, filename)
+
+def read_manifest(filename=packagemanifest):
+    with open(filename) as inf:
+        return [ManifestEntry.parse(line) for line in inf if line.strip()]
+
+def file_digest(args):
+    '''return the hex digest of a file (or None if it can't be read)'''
+    path, algo = args
+    h = hashlib.new(algo)
+    try:
+        with open(path, 'rb') as inf:
+            while True:
+                data = inf.read(2**20)
+                if not data:
+                    break
+                h.update(data)
+    except IOError:
+        return None
+    return h.hexdigest()
+
+def verify_manifest(filename=packagemanifest, basedir=packagedir,
+                    full=False, skip_media=False, workers=None):
+    '''check the files listed in the manifest, relative to basedir.
+       files with the wrong size are bad; files whose mtime has changed
+       are checksummed again (in parallel) to see if they're still OK.
+       with full=True, every file gets checksummed. media/ entries are
+       skipped if skip_media is True (e.g. before the media is set up).
+       returns a list of (name, problem) for the bad files.'''
+    problems = []
+    rehash = []
+    for entry in read_manifest(filename):
+        if skip_media and entry.name.startswith('media/'):
+            continue
+        path = os.path.join(basedir, entry.name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            problems.append((entry.name, "missing"))
+            continue
+        if st.st_size != entry.size:
+            problems.append((entry.name, "size is %u, expected %u"
+                                         % (st.st_size, entry.size)))
+        elif full or int(st.st_mtime) != entry.mtime:
+            rehash.append((entry, path))
+    log.debug("checksumming %u files", len(rehash))
+    digests = parallel_imap(file_digest,
+                            [(p, entry.algo) for (entry, p) in rehash],
+                            workers=workers, threads=True)
+    for (entry, path), digest in izip(rehash, digests):
+        if digest != entry.digest:
+            problems.append((entry.name, "checksum mismatch"))
+    return problems
+
+def main(argv):
+    args = argv[1:]
+    full = '--full' in args
+    if full:
+        args.remove('--full')
+    filename = args[0] if args else packagemanifest
+    basedir = args[1] if len(args) > 1 else os.path.dirname(filename)
+    try:
+        problems = verify_manifest(filename, basedir, full=full)
+    except (IOError, ValueError) as e:
+        print >>sys.stderr, "can't read %s: %s" % (filename, e)
+        return 2
+    for name, problem in problems:
+        print >>sys.stderr, "%s: %s" % (name, problem)
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,222 @@
+# pkgcache.py - bookkeeping for the downloaded package cache
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import time
+import hashlib
+from tempfile import mkstemp
+
+from . import verifyindex, pkgcacheconf, headercachedir
+from .conf import CacheConfig
+from .util import listdir, mkdir_p, rm_f, rm_rf
+
+import logging
+log = logging.getLogger(__package__+".pkgcache")
+
+def file_identity(st):
+    '''a string identifying a particular version of a file, from its stat()'''
+    return "%d %d %r" % (st.st_ino, st.st_size, st.st_mtime)
+
+class VerifyIndex(CacheConfig):
+    '''
+    Persistent record of the cached packages (and boot images) that have
+    already been verified, so we don't have to checksum them all again on
+    every run.
+
+    There's one section per repo (or image). Its 'repodata' option holds the
+    checksum of the metadata the entries were checked against; if that
+    changes, the whole section gets thrown out. The other options map the
+    full path of each verified file to the identity (inode, size, mtime) of
+    the file that passed, so replaced or modified files get checked again.
+    '''
+    def __init__(self, filename=verifyindex):
+        CacheConfig.__init__(self, filename)
+
+    def check_repo(self, repoid, repodata):
+        '''forget everything about repoid if its metadata has changed'''
+        if self.get(repoid, 'repodata') != repodata:
+            if self.has_section(repoid):
+                log.debug("repodata for %s changed, dropping entries", repoid)
+                self.remove_section(repoid)
+            self.set(repoid, 'repodata', repodata)
+
+    def is_verified(self, repoid, filename, st):
+        return self.get(repoid, filename) == file_identity(st)
+
+    def add(self, repoid, filename, st):
+        self.set(repoid, filename, file_identity(st))
+
+    def discard(self, repoid, filename):
+        if self.has_section(repoid):
+            self.remove_option(repoid, filename)
+
+class PackageCache(CacheConfig):
+    '''
+    Usage records for the packages in the cache, used to decide what to
+    keep when the cache is cleaned, plus some hit/miss statistics.
+
+    The 'lastused' section maps the path of each package to the last time
+    (in seconds since the epoch) it was part of an upgrade transaction.
+    The 'stats' section has running totals of cache hits and misses, and
+    of the packages (and bytes) evicted, along with the hits and misses
+    from the most recent run.
+    '''
+    stat_names = ('hits', 'misses', 'evicted', 'evicted_bytes')
+
+    def __init__(self, filename=pkgcacheconf):
+        CacheConfig.__init__(self, filename)
+
+    def stat(self, name):
+        try:
+            return int(self.get('stats', name) or 0)
+        except ValueError:
+            return 0
+
+    def _add_stat(self, name, value):
+        self.set('stats', name, self.stat(name) + value)
+
+    def record(self, hits, misses):
+        '''record the number of cache hits and misses for this run'''
+        self._add_stat('hits', hits)
+        self._add_stat('misses', misses)
+        self.set('stats', 'last_hits', hits)
+        self.set('stats', 'last_misses', misses)
+        if hits + misses:
+            log.info("package cache: %u hits, %u misses (%u%% hit rate)",
+                     hits, misses, 100 * hits / (hits + misses))
+
+    def touch(self, path, now=None):
+        '''note that path is being used (now)'''
+        if now is None:
+            now = time.time()
+        self.set('lastused', path, int(now))
+
+    def lastused(self, path, default=0):
+        try:
+            return int(self.get('lastused', path))
+        except (TypeError, ValueError):
+            return default
+
+    def evict(self, files, keep=(), quota=0, max_age=None, now=None):
+        '''decide which cached packages to remove.
+           files maps each path in the cache to (size, mtime); mtime stands in
+           for the last use of files we don't have records for. files in keep
+           are never removed, and don't count towards the quota. everything
+           else is removed if it hasn't been used for max_age seconds, and
+           then the least recently used files are removed until the rest of
+           the cache fits in quota bytes.
+           returns the list of paths to remove; their records are dropped
+           and counted as evicted.'''
+        if now is None:
+            now = time.time()
+        keep = set(keep)
+        total = sum(size for (path, (size, mtime)) in files.iteritems()
+                    if path not in keep)
+        candidates = sorted((self.lastused(path, int(mtime)), path)
+                            for (path, (size, mtime)) in files.iteritems()
+                            if path not in keep)
+        remove = []
+        for used, path in candidates:
+            expired = max_age is not None and now - used > max_age
+            if not expired and total <= quota:
+                continue
+            remove.append(path)
+            total -= files[path][0]
+            self._add_stat('evicted', 1)
+            self._add_stat('evicted_bytes', files[path][0])
+            if self.has_section('lastused'):
+                self.remove_option('lastused', path)
+        # forget about files that have disappeared
+        if self.has_section('lastused'):
+            for path in self.options('lastused'):
+                if path not in files and path not in keep:
+                    self.remove_option('lastused', path)
+        return remove
+
+class HeaderCache(object):
+    '''
+    Serialized RPM headers of package files, so the headers can be loaded
+    without opening the (much bigger) package files again.
+
+    Each header lives in its own file in the cache dir, named after a hash
+    of the package's path. The first line of that file holds the identity
+    of the package file the header came from (see file_identity) and the
+    sha1 of the header data; the rest is the header data (hdr.unload()).
+    If either doesn't match, the entry is ignored.
+    Entries are written atomically, so this is safe to use from several
+    threads or processes at once.
+    '''
+    def __init__(self, directory=headercachedir):
+        self.dir = directory
+
+    def _entry(self, path):
+        return os.path.join(self.dir, hashlib.sha1(path).hexdigest() + '.hdr')
+
+    def get(self, path, st):
+        '''return the header data for path (given its stat()), or None'''
+        try:
+            with open(self._entry(path), 'rb') as inf:
+                line = inf.readline()
+                data = inf.read()
+        except IOError:
+            return None
+        try:
+            identity, digest = line.rstrip('\n').rsplit('\t', 1)
+        except ValueError:
+            return None
+        if identity != file_identity(st) or \
+                hashlib.sha1(data).hexdigest() != digest:
+            return None
+        return data
+
+    def put(self, path, st, data):
+        '''store the header data for path (given its stat())'''
+        tmp = None
+        try:
+            mkdir_p(self.dir)
+            fd, tmp = mkstemp(prefix='.tmp', dir=self.dir)
+            with os.fdopen(fd, 'wb') as outf:
+                outf.write("%s\t%s\n" % (file_identity(st),
+                                           hashlib.sha1(data).hexdigest()))
+                outf.write(data)
+            os.rename(tmp, self._entry(path))
+        except (IOError, OSError) as e:
+            log.debug("couldn't cache header for %s: %s", path, e)
+            if tmp:
+                rm_f(tmp)
+
+    def invalidate(self, path):
+        '''forget the header for path'''
+        rm_f(self._entry(path))
+
+    def clear(self):
+        '''forget all the headers'''
+        rm_rf(self.dir)
+
+    def size(self):
+        '''return (number of headers, total bytes) in the cache'''
+        count, total = 0, 0
+        if not os.path.isdir(self.dir):
+            return count, total
+        for f in listdir(self.dir):
+            if f.endswith('.hdr'):
+                try:
+                    total += os.path.getsize(f)
+                except OSError:
+                    continue
+                count += 1
+        return count, total
@@ -0,0 +1,148 @@
+# precheck.py - quick checks to run before committing to an upgrade
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import stat
+from collections import namedtuple
+
+from .media import mounts
+from .util import df
+
+import logging
+log = logging.getLogger(__package__+".precheck")
+
+class SpaceEstimate(object):
+    '''
+    Running total of how much the disk usage of each filesystem is going to
+    change during the upgrade.
+
+    Files are assigned to the filesystem mounted closest to them. Packages
+    we don't have file lists for yet can be estimated from their total size,
+    spread over the filesystems the same way as the package they replace.
+    '''
+    def __init__(self, mountpoints=None):
+        if mountpoints is None:
+            mountpoints = [m.mnt for m in mounts()]
+        self.mountpoints = sorted(set(mountpoints), key=len, reverse=True)
+        self.needs = dict()
+
+    def mount_for(self, path):
+        for mnt in self.mountpoints:
+            if path == mnt or path.startswith(mnt.rstrip('/') + '/'):
+                return mnt
+        return '/'
+
+    def add(self, path, size):
+        '''path is going to take up size more bytes (or less, if negative)'''
+        mnt = self.mount_for(path)
+        self.needs[mnt] = self.needs.get(mnt, 0) + size
+
+    def reserve(self, path, size):
+        '''path's filesystem needs at least size bytes free. anything that's
+           already been added there counts towards that, so this only adds
+           what's missing.'''
+        mnt = self.mount_for(path)
+        self.needs[mnt] = max(self.needs.get(mnt, 0), size)
+
+    def add_files(self, files):
+        '''add an iterable of (path, size) pairs'''
+        for path, size in files:
+            self.add(path, size)
+
+    def remove_files(self, files):
+        '''subtract an iterable of (path, size) pairs'''
+        for path, size in files:
+            self.add(path, -size)
+
+    def add_estimate(self, size, like=(), default='/usr'):
+        '''add size bytes, spread over the filesystems in proportion to the
+           given (path, size) pairs, or all on default if there aren't any.'''
+        spread = dict()
+        for path, fsize in like:
+            mnt = self.mount_for(path)
+            spread[mnt] = spread.get(mnt, 0) + fsize
+        total = sum(spread.values())
+        if not total:
+            self.add(default, size)
+            return
+        for mnt, fsize in spread.iteritems():
+            self.add(mnt, size * fsize / total)
+
+    def shortfall(self, free=df):
+        '''return a dict of {mountpoint: bytes} for each filesystem that
+           doesn't have enough free space. free(mnt) gives the free space.'''
+        short = dict()
+        for mnt, need in self.needs.iteritems():
+            if need <= 0:
+                continue
+            try:
+                avail = free(mnt)
+            except OSError as e:
+                log.debug("can't check free space on %s: %s", mnt, e)
+                continue
+            if need > avail:
+                short[mnt] = need - avail
+        return short
+
+class FileInfo(namedtuple('FileInfo', 'mode digest linkto color')):
+    '''the bits of a file's metadata that decide whether two packages
+       containing the same path conflict'''
+    __slots__ = ()
+    def conflicts(self, other):
+        # identical directories can be shared, of course
+        if stat.S_ISDIR(self.mode) and stat.S_ISDIR(other.mode):
+            return False
+        # multilib: rpm picks the file of the preferred color
+        if self.color and other.color and self.color != other.color:
+            return False
+        if stat.S_IFMT(self.mode) != stat.S_IFMT(other.mode):
+            return True
+        if stat.S_ISLNK(self.mode):
+            return self.linkto != other.linkto
+        if stat.S_ISREG(self.mode):
+            return self.digest != other.digest
+        return False
+
+class ConflictIndex(object):
+    '''
+    Index of the files in the new packages, by path, for finding file
+    conflicts without a full test transaction.
+
+    Conflicts between new packages are found as they're added; after that,
+    the file lists of the installed packages that are staying can be checked
+    against the index one package at a time. Conflicts are collected in
+    self.conflicts as (path, newpkg, otherpkg, installed) tuples, where
+    installed says whether otherpkg is an installed package.
+    '''
+    def __init__(self):
+        self.files = dict() # path -> (pkg, FileInfo)
+        self.conflicts = []
+
+    def add_new(self, pkg, files):
+        '''add a new package, given an iterable of (path, FileInfo)'''
+        for path, info in files:
+            other = self.files.get(path)
+            if other is None:
+                self.files[path] = (pkg, info)
+            elif info.conflicts(other[1]):
+                self.conflicts.append((path, pkg, other[0], False))
+
+    def check_installed(self, pkg, files):
+        '''check the files of an installed package that isn't being removed'''
+        for path, info in files:
+            new = self.files.get(path)
+            if new is not None and new[1].conflicts(info):
+                self.conflicts.append((path, new[0], pkg, True))
@@ -0,0 +1,45 @@
+# problems.py - sorting and reporting transaction problems
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# These work on anything with the attributes of an rpm problem (type,
+# pkgNEVR, altNEVR, _str), so they don't need rpm itself.
+
+def group_problems(problems):
+    '''sort problems into a dict of {type: [problem, ...]}, in one pass'''
+    bytype = dict()
+    for p in problems:
+        bytype.setdefault(p.type, []).append(p)
+    return bytype
+
+def problem_report(problems, names=None, top=10):
+    '''a machine-readable report of a list of problems: the total, the
+       count for each type of problem, the packages with the most problems
+       and the problems for each package. names maps problem types to the
+       names used in the report.'''
+    if names is None:
+        names = dict()
+    counts = dict()
+    packages = dict()
+    for p in problems:
+        name = names.get(p.type, str(p.type))
+        counts[name] = counts.get(name, 0) + 1
+        packages.setdefault(p.pkgNEVR, []).append(dict(type=name,
+                                    other=p.altNEVR, detail=p._str))
+    offenders = sorted(packages, key=lambda pkg: (-len(packages[pkg]), pkg))
+    return dict(total=len(problems), counts=counts,
+                top=[(pkg, len(packages[pkg])) for pkg in offenders[:top]],
+                packages=packages)
@@ -0,0 +1,191 @@
+# stage.py - put copies of files in place as cheaply as possible
+#
+# Copyright (C) 2026 Red Hat Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import stat
+import errno
+import fcntl
+from shutil import copyfileobj, copystat
+
+from .util import parallel_imap, rm_rf, hrsize
+
+import logging
+log = logging.getLogger(__package__+".stage")
+
+try:
+    from ctypes import CDLL, get_errno, c_int, c_uint, c_long, c_size_t, c_void_p
+    libc = CDLL("libc.so.6", use_errno=True)
+except (ImportError, OSError):
+    libc = None
+
+# from <linux/fs.h>: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# errors that mean "that doesn't work here, try something else"
+unsupported = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EINVAL,
+               errno.EOPNOTSUPP, errno.ENOSYS, errno.ENOTTY, errno.EBADF)
+
+def _libc_func(name, argtypes):
+    func = getattr(libc, name, None)
+    if func is not None:
+        func.argtypes = argtypes
+        func.restype = c_long
+    return func
+
+if libc is not None:
+    _copy_file_range = _libc_func('copy_file_range',
+                        [c_int, c_void_p, c_int, c_void_p, c_size_t, c_uint])
+    _sendfile = _libc_func('sendfile', [c_int, c_int, c_void_p, c_size_t])
+else:
+    _copy_file_range = _sendfile = None
+
+def _kernel_copy(call, size):
+    '''copy size bytes with call(count), which returns the number of bytes
+       copied, 0 at EOF or -1 on error (like the syscalls do)'''
+    done = 0
+    while done < size:
+        n = call(min(size - done, 2**30))
+        if n < 0:
+            e = get_errno()
+            raise OSError(e, os.strerror(e))
+        if n == 0:
+            break
+        done += n
+    if done != size:
+        raise OSError(errno.EIO, "short copy (%u of %u bytes)" % (done, size))
+
+def reflink(inf, outf, size):
+    fcntl.ioctl(outf.fileno(), FICLONE, inf.fileno())
+
+def copy_range(inf, outf, size):
+    if _copy_file_range is None:
+        raise OSError(errno.ENOSYS, "copy_file_range not available")
+    _kernel_copy(lambda count: _copy_file_range(inf.fileno(), None,
+                                                outf.fileno(), None, count, 0),
+                 size)
+
+def sendfile(inf, outf, size):
+    if _sendfile is None:
+        raise OSError(errno.ENOSYS, "sendfile not available")
+    _kernel_copy(lambda count: _sendfile(outf.fileno(), inf.fileno(),
+                                         None, count), size)
+
+def userspace(inf, outf, size):
+    copyfileobj(inf, outf, 2**20)
+
+# the ways of copying file data, cheapest first
+copy_methods = (('reflink', reflink),
+                ('copy_range', copy_range),
+                ('sendfile', sendfile),
+                ('copy', userspace))
+
+def copy_data(inf, outf, size, methods=copy_methods):
+    '''copy size bytes from inf to outf (starting at their current
+       positions) with the first of the given methods that works.
+       returns the method that worked.'''
+    outf.flush()
+    in_start, out_start = inf.tell(), outf.tell()
+    for method, copy in methods:
+        try:
+            copy(inf, outf, size)
+            break
+        except (IOError, OSError) as e:
+            if method == methods[-1][0] or e.errno not in unsupported:
+                raise
+            log.debug("%s failed (%s), trying something else", method, e)
+            inf.seek(in_start)
+            outf.seek(out_start)
+            outf.truncate()
+    # the kernel methods don't move the file objects' positions
+    outf.seek(out_start + size)
+    return method
+
+def copy_file(src, dst):
+    '''copy src to dst (like shutil.copy2), letting the kernel (or the
+       filesystem) do the work if it can. returns the method that worked.'''
+    size = os.stat(src).st_size
+    with open(src, 'rb') as inf:
+        with open(dst, 'wb') as outf:
+            method = copy_data(inf, outf, size)
+    copystat(src, dst)
+    return method
+
+def stage_file(src, dst):
+    '''make dst a hardlink to src, or a copy if it can't be linked.
+       returns the method used.'''
+    try:
+        os.link(src, dst)
+        return 'link'
+    except OSError as e:
+        if e.errno not in unsupported:
+            raise
+    return copy_file(src, dst)
+
+def same_file(st, other):
+    '''is other (an lstat result) the same as, or a copy of, the file st?'''
+    if (st.st_dev, st.st_ino) == (other.st_dev, other.st_ino):
+        return True
+    return stat.S_ISREG(other.st_mode) and st.st_size == other.st_size \
+        and int(st.st_mtime) == int(other.st_mtime)
+
+def _stage_job(args):
+    src, dst, size, replace = args
+    if replace:
+        rm_rf(dst)
+    return stage_file(src, dst), size
+
+def stage_files(files, destdir, workers=None):
+    '''put a copy of each of the given files in destdir. files is a list of
+       (path, name) pairs; each path is staged as destdir/name, replacing
+       whatever's there unless it's already the same file.
+       the copying is done in parallel. returns (staged, stats): staged is
+       the set of names that are in place, stats maps each method ('present'
+       for files that were already there) to a [count, bytes] pair.'''
+    existing = dict()
+    for name in os.listdir(destdir):
+        try:
+            existing[name] = os.lstat(os.path.join(destdir, name))
+        except OSError:
+            pass
+
+    staged = set()
+    stats = dict()
+    def count(method, size):
+        s = stats.setdefault(method, [0, 0])
+        s[0] += 1
+        s[1] += size
+
+    jobs = []
+    for path, name in files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            log.warning("%s missing", path)
+            continue
+        staged.add(name)
+        old = existing.get(name)
+        if old is not None and same_file(st, old):
+            count('present', st.st_size)
+            continue
+        jobs.append((path, os.path.join(destdir, name), st.st_size,
+                     old is not None))
+
+    for method, size in parallel_imap(_stage_job, jobs, workers, threads=True):
+        count(method, size)
+    for method, (n, size) in sorted(stats.items()):
+        log.info("staged %u files (%s) by %s", n, hrsize(size), method)
+    return staged, stats
@@ -20,13 +20,15 @@
 import glob
 import os
 import re
-from shutil import copy2
 
 from . import _
-from . import cachedir, packagedir, packagelist, update_img_dir
-from . import upgradeconf, upgradelink, upgraderoot
+from . import cachedir, packagedir, packagelist, update_img_dir, verifyindex
+from . import depsolvecache, pkgcacheconf, headercachedir, testresults
+from . import upgradeconf, upgradelink, upgraderoot, initrdpath, kernelpath
 from . import boot
 from .media import write_prep_mount
+from .stage import stage_files
+from .manifest import write_manifest
 from .util import listdir, mkdir_p, rm_f, rm_rf, is_selinux_enabled, kernelver
 from .conf import Config
 from .repofile import RepoFileParser
@@ -49,42 +51,31 @@ def setup_cleanup_post():
 def link_pkgs(pkgs):
     '''link the named pkgs into packagedir, overwriting existing files.
        also removes any .rpm files in packagedir that aren't in pkgs.
-       finally, write a list of packages to upgrade and a list of dirs
-       to clean up after successful upgrade.'''
+       finally, write a list of packages to upgrade (and a manifest with
+       their sizes and checksums) and a list of dirs to clean up after
+       successful upgrade.
+       pkgs need a 'checksum' attribute: the (algo, digest) of the file.'''
 
     log.info("linking required packages into packagedir")
     log.info("packagedir = %s", packagedir)
     mkdir_p(packagedir)
 
     pkgbasenames = set()
+    files = []
+    manifest = dict()
     for pkg in pkgs:
         pkgpath = pkg.localPkg()
         if pkg.remote_url.startswith("file://"):
             pkgbasename = "media/%s" % pkg.relativepath
             pkgbasenames.add(pkgbasename)
-            continue
-        if not os.path.exists(pkgpath):
-            log.warning("%s missing", pkgpath)
-            continue
-        pkgbasename = os.path.basename(pkgpath)
-        pkgbasenames.add(pkgbasename)
-        target = os.path.join(packagedir, pkgbasename)
-        if os.path.exists(target) and os.lstat(pkgpath) == os.lstat(target):
-            log.info("%s already in packagedir", pkgbasename)
-            continue
         else:
-            if os.path.isdir(target):
-                log.info("deleting weirdo directory named %s", pkgbasename)
-                rm_rf(target)
-            elif os.path.exists(target):
-                os.remove(target)
-            try:
-                os.link(pkgpath, target)
-            except OSError as e:
-                if e.errno == 18:
-                    copy2(pkgpath, target)
-                else:
-                    raise
+            pkgbasename = os.path.basename(pkgpath)
+            files.append((pkgpath, pkgbasename))
+        manifest[pkgbasename] = (pkgpath, pkg.checksum)
+
+    # link (or copy) everything that isn't already there
+    staged, stats = stage_files(files, packagedir)
+    pkgbasenames.update(staged)
 
     # remove spurious / leftover RPMs
     for f in os.listdir(packagedir):
@@ -94,6 +85,7 @@ def link_pkgs(pkgs):
     # write packagelist
     with open(packagelist, 'w') as outf:
         outf.writelines(p + '\n' for p in pkgbasenames)
+    write_manifest([(p,) + manifest[p] for p in sorted(pkgbasenames)])
 
     # write cleanup data
     with Config(upgradeconf) as conf:
@@ -185,9 +177,10 @@ def modify_bootloader(kernel, initrd):
 
 def prep_boot(kernel, initrd):
     # check for systems that need mdadm.conf
+    files = []
     if boot.need_mdadmconf():
         log.info("appending /etc/mdadm.conf to initrd")
-        boot.initramfs_append_files(initrd, "/etc/mdadm.conf")
+        files.append("/etc/mdadm.conf")
 
     # look for updates, and add them to initrd if found
     updates = []
@@ -198,7 +191,8 @@ def prep_boot(kernel, initrd):
                  e.strerror)
     if updates:
         log.info("found updates in %s, appending to initrd", update_img_dir)
-        boot.initramfs_append_images(initrd, updates)
+    if files or updates:
+        boot.initramfs_append(initrd, files=files, images=updates)
 
     # make a dir in /lib/modules to hold a copy of the new kernel's modules
     # (the initramfs will copy/bind them into place when we reboot)
@@ -233,16 +227,51 @@ def remove_boot():
         rm_f(initrd)
 
 
-def remove_cache():
-    '''remove our cache dirs'''
+def remove_cache(keep_packages=False):
+    '''remove our cache dirs.
+       if keep_packages is True, the packages downloaded into cachedir (and
+       the index of the ones that have been verified) are left alone so they
+       can be reused; everything else in there (metadata etc.) is removed.'''
     log.info("Removing cache if present from previous run.")
     conf = Config(upgradeconf)
     cleanup = conf.get("cleanup", "dirs") or ''
     cleanup = set(cleanup.split(';'))
     cleanup.update([cachedir, packagedir])  # just to be sure
     for d in cleanup:
-        log.info("removing %s", d)
-        rm_rf(d)
+        if keep_packages and d == cachedir:
+            log.info("removing everything but packages from %s", d)
+            clean_cachedir(d)
+        else:
+            log.info("removing %s", d)
+            rm_rf(d)
+
+
+def clean_cachedir(d=cachedir):
+    '''remove everything from cachedir except <repo>/packages/*.rpm, the
+       package cache records, the header cache, the verify index, the
+       depsolve cache, the last test results and the boot image downloads
+       (finished or not).
+       those all get checked (or revalidated with the server) before use.'''
+    if not os.path.isdir(d):
+        return
+    keep = (verifyindex, depsolvecache, pkgcacheconf, headercachedir,
+            testresults,
+            os.path.join(d, '.treeinfo'),
+            os.path.join(d, os.path.basename(kernelpath)),
+            os.path.join(d, os.path.basename(initrdpath)))
+    for f in listdir(d):
+        if f in keep or f.endswith(('.part', '.journal')):
+            continue
+        if not os.path.isdir(f) or os.path.islink(f):
+            rm_f(f)
+            continue
+        for rf in listdir(f):
+            if os.path.basename(rf) == 'packages' and os.path.isdir(rf):
+                for pf in listdir(rf):
+                    if not pf.endswith(".rpm"):
+                        rm_rf(pf)
+            else:
+                rm_rf(rf)
 
 
 def disable_old_repos():
@@ -115,6 +115,8 @@ class DownloadCallback(DownloadCallbackBase):
     def __init__(self, tty=sys.stderr):
         DownloadCallbackBase.__init__(self)
         self.bar = SimpleProgress(10, tty=tty, prefix=_("verify local files"))
+        self.fetchbar = SimpleProgress(10, tty=tty,
+                                       prefix=_("downloading packages"))
 
     def verify(self, amount, total, filename, data):
         DownloadCallbackBase.verify(self, amount, total, filename, data)
@@ -124,6 +126,14 @@ class DownloadCallback(DownloadCallbackBase):
         if amount == total:
             self.bar.finish()
 
+    def fetch(self, amount, total, filename, data):
+        DownloadCallbackBase.fetch(self, amount, total, filename, data)
+        if self.fetchbar.maxval != total:
+            self.fetchbar.maxval = total
+        self.fetchbar.update(amount)
+        if amount == total:
+            self.fetchbar.finish()
+
     def userconfirm(self):
         def _raw_input_accepting_unicode(prompt):
             # When the terminal is set to a non-ASCII English language, the
@@ -195,13 +195,20 @@ class Treeinfo(RawConfigParser):
         i.e. the value from the [images-*] section (and the key in the
         [checksums] section)
         '''
-        val = self.get('checksums', relpath)
-        algo, checksum = val.split(':',1)
+        algo, checksum = self.checksum(relpath)
         try:
             return checksum == hexdigest(filename, algo)
         except IOError:
             return False
 
+    def checksum(self, relpath):
+        '''
+        Return the (algo, checksum) pair for relpath from [checksums].
+        '''
+        val = self.get('checksums', relpath)
+        algo, checksum = val.split(':',1)
+        return algo, checksum
+
     def add_image(self, arch, imgtype, relpath, topdir=None, algo='sha256'):
         '''
         Add an image to the .treeinfo file: adds an entry to the [images-$arch]
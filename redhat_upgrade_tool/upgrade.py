@@ -22,14 +22,21 @@
 import rpm
 from rpm._rpm import ts as TransactionSetCore
 
-import os, tempfile
-from threading import Thread
+import os
+import multiprocessing
+import json, hashlib
+from itertools import izip
+from threading import local
 
 import logging
 log = logging.getLogger(__package__+'.upgrade')
 
 from . import _
-from .util import df, hrsize
+from . import testresults, timingfile, problemreport
+from .util import df, hrsize, parallel_imap, rm_f, save_json, PhaseTimer
+from .pkgcache import file_identity
+from .logutils import PipeLogger
+from .problems import group_problems, problem_report
 
 class TransactionSet(TransactionSetCore):
     flags = TransactionSetCore._flags
@@ -50,14 +57,19 @@ class TransactionSet(TransactionSetCore):
         return [p for p in self.problems()
                   if p.type in (rpm.RPMPROB_CONFLICT, rpm.RPMPROB_REQUIRES)]
 
-    def add_install(self, path, key=None, upgrade=False):
-        log.debug('add_install(%s, %s, upgrade=%s)', path, key, upgrade)
-        if key is None:
-            key = path
+    def read_header(self, path):
         with open(path) as fileobj:
             retval, header = self.hdrFromFdno(fileobj)
         if retval != rpm.RPMRC_OK:
             raise rpm.error("error reading package header")
+        return header
+
+    def add_install(self, path, key=None, upgrade=False, header=None):
+        log.debug('add_install(%s, %s, upgrade=%s)', path, key, upgrade)
+        if key is None:
+            key = path
+        if header is None:
+            header = self.read_header(path)
         if not self.addInstall(header, key, upgrade):
             raise rpm.error("adding package to transaction failed")
 
@@ -79,6 +91,11 @@ probtypes = { rpm.RPMPROB_NEW_FILE_CONFLICT : _('file conflicts'),
 # --- stuff for doing useful summaries of big sets of problems
 
 probattrs = ('type', 'pkgNEVR', 'altNEVR', 'key', '_str', '_num')
+# short names for the problem types, for the problem report
+probnames = dict((rpm.__dict__[k], k[8:].lower())
+                  for k in rpm.__dict__
+                  if k.startswith('RPMPROB_') and
+                     not k.startswith('RPMPROB_FILTER_'))
 def prob2dict(p):
     dict = {}
     for f in probattrs:
@@ -86,9 +103,12 @@ def prob2dict(p):
     return dict
 
 class ProblemSummary(object):
+    # don't flood the debug log with tens of thousands of problems
+    maxlog = 100
+
     def __init__(self, probtype, problems):
         self.type = probtype
-        self.problems = [p for p in problems if p.type == self.type]
+        self.problems = problems # just the ones of this type
         self.desc = probtypes.get(probtype)
         self.details = self.get_details()
 
@@ -99,8 +119,11 @@ class ProblemSummary(object):
         raise NotImplementedError
 
     def _log_probs(self):
-        for p in self.problems:
+        for p in self.problems[:self.maxlog]:
             log.debug('%s -> "%s"', prob2dict(p), p)
+        if len(self.problems) > self.maxlog:
+            log.debug('(and %u more %s problems)',
+                      len(self.problems) - self.maxlog, self.desc)
 
     def __str__(self):
         if self.details:
@@ -137,6 +160,20 @@ class DepProblemSummary(ProblemSummary):
         return [_("%s requires %s") % (pkg, ", ".join(pkgprob))
                  for (pkg, pkgprob) in self.details.iteritems()]
 
+class FileConflictProblemSummary(ProblemSummary):
+    def get_details(self):
+        self._log_probs()
+        conflicts = dict()
+        # conflicts[(pkg, otherpkg)] = [file1, file2, ...]
+        for p in self.problems:
+            conflicts.setdefault((p.pkgNEVR, p.altNEVR), []).append(p._str)
+        return conflicts
+
+    def format_details(self):
+        return [_("%s conflicts with %s (%u files, e.g. %s)")
+                    % (pkg, other, len(files), sorted(files)[0])
+                 for ((pkg, other), files) in sorted(self.details.items())]
+
 # If there is no handler for a type of problem, just return the
 # rpmProblemString result for the problems
 class GenericProblemSummary(ProblemSummary):
@@ -145,32 +182,169 @@ class GenericProblemSummary(ProblemSummary):
 
 probsummary = { rpm.RPMPROB_DISKSPACE: DiskspaceProblemSummary,
                 rpm.RPMPROB_REQUIRES:  DepProblemSummary,
+                rpm.RPMPROB_FILE_CONFLICT: FileConflictProblemSummary,
+                rpm.RPMPROB_NEW_FILE_CONFLICT: FileConflictProblemSummary,
               }
 
 
 def summarize_problems(problems):
     summaries = []
-    for t in set(p.type for p in problems):
+    for t, probs in group_problems(problems).iteritems():
         summarize = probsummary.get(t, GenericProblemSummary) # get the summarizer
-        summaries.append(summarize(t, problems))       # summarize the problem
+        summaries.append(summarize(t, probs))          # summarize the problem
     return summaries
 
+def save_problem_report(problems, filename=problemreport):
+    '''save a problem_report for problems as JSON'''
+    save_json(filename, problem_report(problems, probnames), "problem report",
+              indent=2, sort_keys=True, default=str)
+
 class TransactionError(Exception):
     def __init__(self, problems):
         self.problems = problems
         self.summaries = summarize_problems(problems)
 
-def pipelogger(pipe, level=logging.INFO):
-    logger = logging.getLogger(__package__+".rpm")
-    logger.info("opening pipe")
-    with open(pipe, 'r') as fd:
-        for line in fd:
-            if line.startswith('D: '):
-                logger.debug(line[3:].rstrip())
-            else:
-                logger.log(level, line.rstrip())
-        logger.info("got EOF")
-    logger.info("exiting")
+# --- remembering test results between runs
+
+class StoredProblem(object):
+    '''a problem loaded from saved test results. it has the same attributes
+       (and string form) as the rpm problem it was saved from.'''
+    def __init__(self, probdict):
+        for f in probattrs:
+            setattr(self, f, probdict.get(f))
+        self.desc = probdict.get('desc') or ''
+
+    def __str__(self):
+        if isinstance(self.desc, unicode):
+            return self.desc.encode('utf-8')
+        return self.desc
+
+def diskspace_problems(needs):
+    '''turn a dict of {mountpoint: bytes needed} into a list of problems
+       that look like the ones rpm reports'''
+    return [StoredProblem(dict(type=rpm.RPMPROB_DISKSPACE, _str=mnt, _num=size,
+                               desc=_("%s needs %s more free space")
+                                    % (mnt, hrsize(size))))
+            for (mnt, size) in needs.iteritems()]
+
+def conflict_problems(conflicts):
+    '''turn a list of conflicts from a ConflictIndex into a list of problems
+       that look like the ones rpm reports'''
+    problems = []
+    for (path, pkg, other, installed) in conflicts:
+        if installed:
+            probtype = rpm.RPMPROB_FILE_CONFLICT
+            desc = _("file %s from install of %s conflicts with file from "
+                     "package %s") % (path, pkg, other)
+        else:
+            probtype = rpm.RPMPROB_NEW_FILE_CONFLICT
+            desc = _("file %s conflicts between attempted installs of %s "
+                     "and %s") % (path, pkg, other)
+        problems.append(StoredProblem(dict(type=probtype, pkgNEVR=pkg,
+                                           altNEVR=other, _str=path,
+                                           desc=desc)))
+    return problems
+
+def saveprob(p):
+    d = prob2dict(p)
+    d['desc'] = str(p)
+    return d
+
+def test_fingerprint(pkgfiles, root='/'):
+    '''fingerprint the inputs of a test transaction: the package files
+       (by path and identity) and the state of the rpmdb.'''
+    h = hashlib.sha256()
+    for path in sorted(pkgfiles):
+        try:
+            h.update("%s %s\n" % (path, file_identity(os.stat(path))))
+        except OSError:
+            h.update("%s missing\n" % path)
+    rpmdb = os.path.join(root, 'var/lib/rpm/Packages')
+    try:
+        h.update("rpmdb %s\n" % file_identity(os.stat(rpmdb)))
+    except OSError:
+        h.update("rpmdb missing\n")
+    return h.hexdigest()
+
+class TestResults(object):
+    '''
+    The results of the last test transaction, saved so they can be reused
+    if the next run would test exactly the same thing (see test_fingerprint).
+    The results are the problems found by the transaction check, the
+    problems that made the test fail (if it did) and the return value.
+    '''
+    def __init__(self, filename=testresults):
+        self.filename = filename
+
+    def load(self, fingerprint):
+        '''return (checkerr, testerr, rv) for the given fingerprint, where
+           checkerr and testerr are TransactionErrors (or None). returns
+           None if there are no matching results.'''
+        try:
+            with open(self.filename) as inf:
+                data = json.load(inf)
+            if data['fingerprint'] != fingerprint:
+                log.debug("saved test results are out of date")
+                return None
+            errs = []
+            for probs in (data['check'], data['test']):
+                if probs is None:
+                    errs.append(None)
+                else:
+                    errs.append(TransactionError([StoredProblem(p)
+                                                  for p in probs]))
+            return errs[0], errs[1], data['rv']
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, fingerprint, checkerr, testerr, rv):
+        data = dict(fingerprint=fingerprint, rv=rv, check=None, test=None)
+        if checkerr:
+            data['check'] = [saveprob(p) for p in checkerr.problems]
+        if testerr:
+            data['test'] = [saveprob(p) for p in testerr.problems]
+        save_json(self.filename, data, "test results", default=str)
+
+    def clear(self):
+        rm_f(self.filename)
+
+# transaction sets aren't thread-safe, so each header-reading thread gets its
+# own one of these
+_thread_ts = local()
+
+def load_header(args):
+    '''read the header from a package file, in a worker thread.
+       if hdrcache (a HeaderCache) is given, the header is taken from there
+       if possible, and stored there otherwise.
+       returns (header, errmsg); header is None if it couldn't be read.'''
+    (root, path, hdrcache) = args
+    if hdrcache:
+        st = os.stat(path)
+        data = hdrcache.get(path, st)
+        if data is not None:
+            try:
+                return rpm.hdr(data), None
+            except (rpm.error, TypeError):
+                log.debug("bad cached header for %s", path)
+    ts = getattr(_thread_ts, 'ts', None)
+    if ts is None:
+        ts = _thread_ts.ts = TransactionSet(root, rpm._RPMVSF_NOSIGNATURES)
+    try:
+        header = ts.read_header(path)
+    except rpm.error as e:
+        return None, str(e)
+    if hdrcache:
+        hdrcache.put(path, st, header.unload())
+    return header, None
+
+def load_headers(pkgfiles, root='/', workers=None, hdrcache=None):
+    '''read the headers of the given package files using a pool of threads.
+       yields (path, header, errmsg) for each file, in the given order.'''
+    results = parallel_imap(load_header,
+                            [(root, p, hdrcache) for p in pkgfiles],
+                            workers=workers, threads=True)
+    for path, (header, err) in izip(pkgfiles, results):
+        yield path, header, err
 
 logging_to_rpm = {
     logging.DEBUG:      rpm.RPMLOG_DEBUG,
@@ -184,26 +358,35 @@ class RPMUpgrade(object):
     def __init__(self, root='/', logpipe=True, rpmloglevel=logging.INFO):
         self.root = root
         self.ts = None
+        self.timer = PhaseTimer()
         self.logpipe = None
         rpm.setVerbosity(logging_to_rpm[rpmloglevel])
         if logpipe:
             self.logpipe = self.openpipe()
 
-    def setup_transaction(self, pkgfiles, check_fatal=False):
+    def setup_transaction(self, pkgfiles, check_fatal=False, workers=None,
+                          hdrcache=None):
         log.debug("starting")
         # initialize a transaction set
         self.ts = TransactionSet(self.root, rpm._RPMVSF_NOSIGNATURES)
         if self.logpipe:
             self.ts.scriptFd = self.logpipe.fileno()
-        # populate the transaction set
-        for pkg in pkgfiles:
-            try:
-                self.ts.add_install(pkg, upgrade=True)
-            except rpm.error as e:
-                log.warn('error adding pkg: %s', e)
-                # TODO: error callback
+        # read the headers in parallel, then populate the transaction set
+        # in a consistent order
+        pkgfiles = sorted(pkgfiles)
+        with self.timer.phase('headers'):
+            for pkg, header, err in load_headers(pkgfiles, self.root, workers,
+                                                 hdrcache):
+                try:
+                    if err:
+                        raise rpm.error(err)
+                    self.ts.add_install(pkg, upgrade=True, header=header)
+                except rpm.error as e:
+                    log.warn('error adding pkg: %s', e)
+                    # TODO: error callback
         log.debug('ts.check()')
-        problems = self.ts.check() or []
+        with self.timer.phase('check'):
+            problems = self.ts.check() or []
         if problems:
             log.info("problems with transaction check:")
             for p in problems:
@@ -212,25 +395,19 @@ class RPMUpgrade(object):
                 raise TransactionError(problems=problems)
 
         log.debug('ts.order()')
-        self.ts.order()
+        with self.timer.phase('order'):
+            self.ts.order()
         log.debug('ts.clean()')
-        self.ts.clean()
+        with self.timer.phase('clean'):
+            self.ts.clean()
         log.debug('transaction is ready')
         if problems:
             return TransactionError(problems=problems)
 
     def openpipe(self):
         log.debug("creating log pipe")
-        pipefile = tempfile.mktemp(prefix='rpm-log-pipe.')
-        os.mkfifo(pipefile, 0600)
-        log.debug("starting logging thread")
-        pipethread = Thread(target=pipelogger, name='pipelogger',
-                                 args=(pipefile,))
-        pipethread.daemon = True
-        pipethread.start()
-        log.debug("opening log pipe")
-        pipe = open(pipefile, 'w')
-        rpm.setLogFile(pipe)
+        pipe = PipeLogger(logging.getLogger(__package__+".rpm"))
+        rpm.setLogFile(pipe.pipe)
         return pipe
 
     def closepipe(self):
@@ -240,13 +417,16 @@ class RPMUpgrade(object):
         if self.ts:
             self.ts.scriptFd = None
         self.logpipe.close()
-        os.remove(self.logpipe.name)
         self.logpipe = None
 
     def run_transaction(self, callback):
         assert callable(callback.callback)
         probfilter = ~rpm.RPMPROB_FILTER_DISKSPACE
-        rv = self.ts.run(callback.callback, None, probfilter)
+        try:
+            with self.timer.phase('run'):
+                rv = self.ts.run(callback.callback, None, probfilter)
+        finally:
+            log.debug("transaction timing: %s", self.timer.record())
         if rv != 0:
             log.info("ts completed with problems - code %u", rv)
         return rv
@@ -261,3 +441,123 @@ class RPMUpgrade(object):
     def __del__(self):
         if self.logpipe:
             self.closepipe()
+
+def timing_record(timer, callback=None):
+    '''a summary of where the time went in a transaction: the time spent in
+       each phase (from timer) and the number of callbacks of each type, and
+       the time spent handling them (from callback, if it keeps count)'''
+    record = dict(phases=timer.record())
+    if hasattr(callback, "callback_stats"):
+        record['callbacks'] = callback.callback_stats()
+    return record
+
+def save_timing(record, filename=timingfile):
+    '''log a timing record and save it as JSON'''
+    log.debug("timing summary: %s", json.dumps(record))
+    save_json(filename, record, "timing summary", indent=2, sort_keys=True)
+
+# --- running the test transaction in a separate process
+
+class TransactionWorkerError(Exception):
+    pass
+
+class WorkerCallback(object):
+    '''transaction callback for the test worker: opens and closes package
+       files for rpm, and sends every event back to the parent over conn'''
+    def __init__(self, conn):
+        self.conn = conn
+        self._openfds = dict()
+
+    def callback(self, what, amount, total, key, data):
+        if key is None or isinstance(key, basestring):
+            sendkey = key
+        else:
+            sendkey = str(key)
+        self.conn.send(('callback', (what, amount, total, sendkey)))
+        if what == rpm.RPMCALLBACK_INST_OPEN_FILE:
+            f = open(key, 'r')
+            self._openfds[key] = f
+            return f.fileno()
+        elif what == rpm.RPMCALLBACK_INST_CLOSE_FILE:
+            self._openfds.pop(key).close()
+
+# callbacks that WorkerCallback handles in the worker and that aren't passed on
+worker_file_callbacks = (rpm.RPMCALLBACK_INST_OPEN_FILE,
+                         rpm.RPMCALLBACK_INST_CLOSE_FILE)
+
+def test_worker(conn, pkgfiles, root, workers, hdrcache):
+    '''set up and test the transaction, and send the results back over conn.
+       runs in a child process (see run_test_worker).'''
+    fu = None
+    try:
+        fu = RPMUpgrade(root)
+        checkerr = fu.setup_transaction(pkgfiles, check_fatal=False,
+                                        workers=workers, hdrcache=hdrcache)
+        check = None
+        if checkerr:
+            check = [saveprob(p) for p in checkerr.problems]
+        try:
+            rv = fu.test_transaction(WorkerCallback(conn))
+        except TransactionError as e:
+            conn.send(('failed', (check, [saveprob(p) for p in e.problems],
+                                  fu.timer.record())))
+        else:
+            conn.send(('done', (check, rv, fu.timer.record())))
+    except Exception as e:
+        log.debug("test transaction worker failed", exc_info=True)
+        conn.send(('error', str(e)))
+    finally:
+        # the child exits without cleaning up, so flush rpm's log output now
+        if fu and fu.logpipe:
+            fu.closepipe()
+        conn.close()
+
+def run_test_worker(pkgfiles, callback, root='/', workers=None, hdrcache=None,
+                    timer=None):
+    '''run the test transaction for the given package files in a child
+       process, so rpm's memory goes away when it's done and a crash in rpm
+       doesn't take us down with it. transaction callbacks are passed to
+       callback as they happen.
+       the time the worker spent in each phase is added to timer, if given.
+       returns (checkerr, testerr, rv), like TestResults.load().
+       raises TransactionWorkerError if the worker fails or dies.'''
+    reader, writer = multiprocessing.Pipe(duplex=False)
+    w = multiprocessing.Process(target=test_worker, name="rpm-test",
+                                args=(writer, sorted(pkgfiles), root,
+                                      workers, hdrcache))
+    w.start()
+    writer.close()
+    result = None
+    try:
+        while result is None:
+            try:
+                msg, data = reader.recv()
+            except EOFError:
+                break
+            if msg == 'callback':
+                what, amount, total, key = data
+                # the worker opens and closes the package files itself
+                if what not in worker_file_callbacks:
+                    callback.callback(what, amount, total, key, None)
+            else:
+                result = (msg, data)
+    finally:
+        reader.close()
+        w.join()
+    if result is None:
+        raise TransactionWorkerError(_("test transaction worker exited "
+                                       "unexpectedly (exit code %s)")
+                                     % w.exitcode)
+    msg, data = result
+    if msg == 'error':
+        raise TransactionWorkerError(data)
+    if timer is not None:
+        for name, seconds in data[2]:
+            timer.add(name, seconds)
+    def loaderr(probs):
+        if probs is None:
+            return None
+        return TransactionError([StoredProblem(p) for p in probs])
+    if msg == 'failed':
+        return loaderr(data[0]), loaderr(data[1]), None
+    return loaderr(data[0]), None, data[1]
@@ -17,8 +17,12 @@
 #
 # Author: Will Woods <wwoods@redhat.com>
 
-import os, struct
+import os, struct, time
+import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from shutil import rmtree
+from contextlib import contextmanager
 from subprocess import Popen, CalledProcessError, PIPE, STDOUT
 from pipes import quote as shellquote
 from redhat_upgrade_tool import grub_conf_file
@@ -68,6 +72,48 @@ def rlistdir(d):
         for f in files:
             yield os.path.join(root, f)
 
+def worker_count(workers=None):
+    '''return the number of workers to use for parallel jobs.
+       defaults to one per CPU.'''
+    if workers is None:
+        try:
+            workers = multiprocessing.cpu_count()
+        except NotImplementedError:
+            workers = 1
+    return max(1, int(workers))
+
+def parallel_imap(func, items, workers=None, threads=False):
+    '''like itertools.imap(func, items), but spread the work over a pool of
+       worker processes (or threads, if threads is True).
+       results are yielded in the same order as items. if there's only one
+       worker (or one item) everything runs in the calling process.
+       NOTE: with worker processes, func must be picklable (i.e. defined at
+       module level) and so must the items and results.'''
+    items = list(items)
+    workers = min(worker_count(workers), len(items))
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+    if threads:
+        pool = ThreadPool(workers)
+    else:
+        pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.imap(func, items)
+        while True:
+            # NOTE: without a timeout the wait can't be interrupted by ^C
+            try:
+                yield results.next(timeout=2**31)
+            except StopIteration:
+                break
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
 def mkdir_p(d):
     try:
         os.makedirs(d)
@@ -89,6 +135,19 @@ def rm_rf(d):
     else:
         rm_f(d)
 
+def save_json(filename, data, what, **dumpargs):
+    '''write data to filename as JSON. if that fails, log a warning (what
+       says what the data is) and don't leave a partial file behind.
+       returns True if it worked.'''
+    try:
+        with open(filename, 'w') as outf:
+            json.dump(data, outf, **dumpargs)
+        return True
+    except (IOError, TypeError, ValueError) as e:
+        log.warn("couldn't save %s to %s: %s", what, filename, e)
+        rm_f(filename)
+        return False
+
 def kernelver(filename):
     '''read the version number out of a vmlinuz file.'''
     # this algorithm came from /usr/share/magic
@@ -122,3 +181,34 @@ def hrsize(size, si=False, use_ib=False):
                 return "%u%s%s" % (int(size)+1, p, suffix)
             else:
                 return "%.1f%s%s" % (size, p, suffix)
+
+class PhaseTimer(object):
+    '''
+    Wall-clock time spent in each phase of a job, in the order the phases
+    first ran. Time spent in a phase that runs more than once is added up.
+
+        with timer.phase('check'):
+            ts.check()
+    '''
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.phases = []
+        self._seconds = dict()
+
+    @contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, self.clock() - start)
+
+    def add(self, name, seconds):
+        if name not in self._seconds:
+            self.phases.append(name)
+            self._seconds[name] = 0.0
+        self._seconds[name] += seconds
+
+    def record(self):
+        '''return [(phase, seconds), ...] in order'''
+        return [(name, round(self._seconds[name], 3)) for name in self.phases]
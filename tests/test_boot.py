@@ -0,0 +1,52 @@
+import gzip
+from StringIO import StringIO
+from redhat_upgrade_tool import boot
+
+
+def read_newc(data):
+    """ parse a newc cpio archive into a list of (name, mode, contents) """
+    entries = []
+    pos = 0
+    while True:
+        assert data[pos:pos+6] == '070701'
+        fields = [int(data[pos+6+8*i:pos+14+8*i], 16) for i in range(13)]
+        mode, size, namesize = fields[1], fields[6], fields[11]
+        pos += 110
+        name = data[pos:pos+namesize-1]
+        pos += namesize + (-(110 + namesize) % 4)
+        if name == 'TRAILER!!!':
+            return entries, data[pos:]
+        entries.append((name, mode, data[pos:pos+size]))
+        pos += size + (-size % 4)
+
+
+def test_initramfs_append(tmpdir):
+    """ initramfs_append adds files as a cpio archive, then the images """
+    initrd = tmpdir.join('initrd.img')
+    initrd.write('INITRD')
+    conf = tmpdir.join('mdadm.conf')
+    conf.write('ARRAY /dev/md0\n')
+    img = tmpdir.join('update.img')
+    img.write('IMAGE' * 1000)
+
+    boot.initramfs_append(str(initrd), files=[str(conf)], images=[str(img)])
+    data = initrd.read('rb')
+    assert data.startswith('INITRD')
+    entries, rest = read_newc(data[len('INITRD'):])
+    assert [(n, c) for (n, m, c) in entries] == \
+           [(str(conf).lstrip('/'), 'ARRAY /dev/md0\n')]
+    assert entries[0][1] & 0777 == conf.stat().mode & 0777
+    assert rest == 'IMAGE' * 1000
+
+
+def test_initramfs_append_compressed(tmpdir):
+    """ initramfs_append can gzip the cpio archive """
+    initrd = tmpdir.join('initrd.img')
+    initrd.write('')
+    conf = tmpdir.join('mdadm.conf')
+    conf.write('ARRAY /dev/md0\n')
+    boot.initramfs_append_files(str(initrd), str(conf), compress=True)
+    data = gzip.GzipFile(fileobj=StringIO(initrd.read('rb'))).read()
+    entries, rest = read_newc(data)
+    assert entries[0][2] == 'ARRAY /dev/md0\n'
+    assert rest == ''
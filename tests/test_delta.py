@@ -0,0 +1,44 @@
+from StringIO import StringIO
+from redhat_upgrade_tool import delta
+
+PRESTODELTA = """<?xml version="1.0" encoding="UTF-8"?>
+<prestodelta>
+  <newpackage name="foo" epoch="0" version="1.2" release="1" arch="x86_64">
+    <delta oldepoch="0" oldversion="1.0" oldrelease="1">
+      <filename>drpms/foo-1.0-1_1.2-1.x86_64.drpm</filename>
+      <sequence>foo-1.0-1-abc</sequence>
+      <size>3000</size>
+      <checksum type="sha256">aaaa</checksum>
+    </delta>
+    <delta oldepoch="0" oldversion="1.1" oldrelease="1">
+      <filename>drpms/foo-1.1-1_1.2-1.x86_64.drpm</filename>
+      <sequence>foo-1.1-1-def</sequence>
+      <size>1000</size>
+      <checksum type="sha256">bbbb</checksum>
+    </delta>
+  </newpackage>
+</prestodelta>
+"""
+
+NEWFOO = ('foo', 'x86_64', '0', '1.2', '1')
+
+
+def test_read_prestodelta():
+    """ read_prestodelta finds all the deltas for each new package """
+    deltas = delta.read_prestodelta(StringIO(PRESTODELTA))
+    assert deltas.keys() == [NEWFOO]
+    info = deltas[NEWFOO][('0', '1.1', '1')]
+    assert info.filename == 'drpms/foo-1.1-1_1.2-1.x86_64.drpm'
+    assert info.size == 1000
+    assert (info.csum_type, info.csum) == ('sha256', 'bbbb')
+
+
+def test_find_delta():
+    """ find_delta picks the smallest usable delta """
+    deltas = delta.read_prestodelta(StringIO(PRESTODELTA))
+    both = [('0', '1.0', '1'), ('0', '1.1', '1')]
+    assert delta.find_delta(deltas, NEWFOO, both).size == 1000
+    assert delta.find_delta(deltas, NEWFOO, both[:1]).size == 3000
+    assert delta.find_delta(deltas, NEWFOO, both[:1], maxsize=2000) is None
+    assert delta.find_delta(deltas, NEWFOO, [('0', '0.9', '1')]) is None
+    assert delta.find_delta(deltas, ('bar',) + NEWFOO[1:], both) is None
@@ -0,0 +1,31 @@
+import logging
+from redhat_upgrade_tool import logutils
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, record.getMessage()))
+
+
+def test_pipelogger():
+    """ PipeLogger logs lines from the pipe and collapses repeats """
+    logger = logging.getLogger('test_pipelogger')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = ListHandler()
+    logger.addHandler(handler)
+
+    pipe = logutils.PipeLogger(logger)
+    pipe.pipe.write("first\nD: debug\n" + "same\n" * 5 + "last")
+    pipe.close()
+    assert handler.messages == [
+        (logging.INFO, 'first'),
+        (logging.DEBUG, 'debug'),
+        (logging.INFO, 'same'),
+        (logging.INFO, '(last line repeated 4 more times)'),
+        (logging.INFO, 'last'),
+    ]
@@ -0,0 +1,29 @@
+import os
+from redhat_upgrade_tool import manifest
+
+
+def test_verify_manifest(tmpdir):
+    """ verify_manifest finds missing, truncated and modified files """
+    names = ('a.rpm', 'b.rpm', 'c.rpm', 'd.rpm', 'media/e.rpm')
+    tmpdir.mkdir('media')
+    entries = []
+    for name in names:
+        f = tmpdir.join(name)
+        f.write(name * 100)
+        digest = manifest.file_digest((str(f), 'sha256'))
+        entries.append((name, str(f), ('sha256', digest)))
+    mfile = str(tmpdir.join('package.manifest'))
+    manifest.write_manifest(entries, mfile)
+
+    assert manifest.verify_manifest(mfile, str(tmpdir)) == []
+    tmpdir.join('a.rpm').remove()
+    tmpdir.join('b.rpm').write('short')
+    # same size, different data and mtime
+    tmpdir.join('c.rpm').write('x' * 500)
+    os.utime(str(tmpdir.join('c.rpm')), (1, 1))
+    tmpdir.join('media/e.rpm').remove()
+    assert manifest.verify_manifest(mfile, str(tmpdir), skip_media=True) == [
+        ('a.rpm', 'missing'),
+        ('b.rpm', 'size is 5, expected 500'),
+        ('c.rpm', 'checksum mismatch'),
+    ]
@@ -0,0 +1,83 @@
+from collections import namedtuple
+from redhat_upgrade_tool import pkgcache
+
+stat_result = namedtuple('stat_result', 'st_ino st_size st_mtime')
+
+
+def test_verify_index():
+    """ VerifyIndex remembers verified files until they or the repo change """
+    index = pkgcache.VerifyIndex('/nonexistent/verified.conf')
+    st = stat_result(1234, 5678, 1500000000.5)
+    path = '/var/tmp/system-upgrade/repo/packages/Foo-1.0-1.x86_64.rpm'
+
+    index.check_repo('repo', 'abc123')
+    assert not index.is_verified('repo', path, st)
+    index.add('repo', path, st)
+    assert index.is_verified('repo', path, st)
+
+    # modified file
+    assert not index.is_verified('repo', path, st._replace(st_mtime=1600000000.0))
+    # same metadata keeps the entry, new metadata drops it
+    index.check_repo('repo', 'abc123')
+    assert index.is_verified('repo', path, st)
+    index.check_repo('repo', 'def456')
+    assert not index.is_verified('repo', path, st)
+
+    index.add('repo', path, st)
+    index.discard('repo', path)
+    assert not index.is_verified('repo', path, st)
+
+
+def test_package_cache_evict():
+    """ PackageCache evicts old packages first, and never the ones in use """
+    cache = pkgcache.PackageCache('/nonexistent/pkgcache.conf')
+    files = {'/c/old.rpm': (100, 1000), '/c/new.rpm': (100, 3000),
+             '/c/used.rpm': (100, 1000), '/c/mid.rpm': (100, 2000)}
+    cache.touch('/c/used.rpm', now=5000)
+    cache.touch('/c/gone.rpm', now=5000)
+
+    # everything fits: nothing to do
+    assert cache.evict(files, quota=400, now=5000) == []
+    # too big: least recently used go first, but kept files stay (and
+    # don't count towards the quota)
+    assert cache.evict(files, keep=['/c/old.rpm'], quota=100,
+                       now=5000) == ['/c/mid.rpm', '/c/new.rpm']
+    # the kept files alone are over the quota: the rest still gets its share
+    del files['/c/mid.rpm'], files['/c/new.rpm']
+    files['/c/big.rpm'] = (1000, 4000)
+    assert cache.evict(files, keep=['/c/big.rpm'], quota=200,
+                       now=5000) == []
+    # expired, even though there's room
+    assert cache.evict(files, keep=['/c/big.rpm'], quota=1000, max_age=3000,
+                       now=5000) == ['/c/old.rpm']
+    assert cache.stat('evicted') == 3
+    assert cache.stat('evicted_bytes') == 300
+    # records of missing files are dropped
+    assert cache.lastused('/c/gone.rpm') == 0
+    assert cache.lastused('/c/used.rpm') == 5000
+
+
+def test_package_cache_stats():
+    """ PackageCache keeps running totals of hits and misses """
+    cache = pkgcache.PackageCache('/nonexistent/pkgcache.conf')
+    cache.record(hits=3, misses=1)
+    cache.record(hits=5, misses=0)
+    assert cache.stat('hits') == 8
+    assert cache.stat('misses') == 1
+    assert cache.stat('last_hits') == 5
+
+
+def test_header_cache(tmpdir):
+    """ HeaderCache returns stored headers only for the same file """
+    cache = pkgcache.HeaderCache(str(tmpdir))
+    st = stat_result(1234, 5678, 1500000000.5)
+    path = '/var/tmp/system-upgrade/repo/packages/Foo-1.0-1.x86_64.rpm'
+
+    assert cache.get(path, st) is None
+    cache.put(path, st, 'header\ndata\0')
+    assert cache.get(path, st) == 'header\ndata\0'
+    assert cache.get(path, st._replace(st_size=1)) is None
+    assert cache.get(path + '.other', st) is None
+    assert cache.size() == (1, len(open(cache._entry(path)).read()))
+    cache.invalidate(path)
+    assert cache.get(path, st) is None
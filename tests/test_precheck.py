@@ -0,0 +1,71 @@
+from redhat_upgrade_tool import precheck
+
+MOUNTS = ['/', '/boot', '/var', '/usr']
+
+
+def test_mount_for():
+    """ files belong to the filesystem mounted closest to them """
+    est = precheck.SpaceEstimate(MOUNTS)
+    assert est.mount_for('/usr/bin/ls') == '/usr'
+    assert est.mount_for('/usr') == '/usr'
+    assert est.mount_for('/usrlocal/x') == '/'
+    assert est.mount_for('/var/tmp/system-upgrade') == '/var'
+
+
+def test_space_estimate():
+    """ SpaceEstimate adds up what's installed and removed per filesystem """
+    est = precheck.SpaceEstimate(MOUNTS)
+    old = [('/usr/bin/foo', 300), ('/etc/foo.conf', 100)]
+    est.remove_files(old)
+    est.add_files([('/usr/bin/foo', 500), ('/etc/foo.conf', 100)])
+    assert est.needs == {'/usr': 200, '/': 0}
+    # estimates are spread out like the given files
+    est.add_estimate(800, like=old)
+    assert est.needs == {'/usr': 800, '/': 200}
+    est.add_estimate(100)
+    assert est.needs['/usr'] == 900
+    est.add('/boot', -50)
+
+    free = {'/usr': 1000, '/': 100, '/boot': 0}
+    assert est.shortfall(free=free.get) == {'/': 100}
+
+
+def test_conflict_index():
+    """ ConflictIndex finds new-vs-new and new-vs-installed conflicts """
+    reg = lambda digest, color=0: precheck.FileInfo(0100644, digest, '', color)
+    dir = precheck.FileInfo(040755, '', '', 0)
+    link = lambda target: precheck.FileInfo(0120777, '', target, 0)
+
+    index = precheck.ConflictIndex()
+    index.add_new('a', [('/d', dir), ('/f', reg('1')), ('/lib/x', reg('1', 1)),
+                        ('/l', link('/f'))])
+    index.add_new('b', [('/d', dir), ('/f', reg('2')), ('/lib/x', reg('2', 2)),
+                        ('/l', link('/f'))])
+    assert index.conflicts == [('/f', 'b', 'a', False)]
+
+    index.check_installed('old', [('/d', dir), ('/f', reg('1')),
+                                  ('/l', link('/elsewhere')), ('/other', reg('3'))])
+    assert index.conflicts[1:] == [('/l', 'a', 'old', True)]
+
+
+def test_boot_reserve():
+    """ the /boot reserve covers the new kernel's files, not on top of them """
+    reserve = 50 * 2**20
+    est = precheck.SpaceEstimate(MOUNTS)
+    est.add_files([('/boot/vmlinuz-new', 5 * 2**20),
+                   ('/boot/System.map-new', 3 * 2**20)])
+    est.reserve('/boot', reserve)
+    assert est.needs['/boot'] == reserve
+    assert est.shortfall(free={'/boot': reserve}.get) == {}
+    assert est.shortfall(free={'/boot': reserve - 1}.get) == {'/boot': 1}
+
+    # a kernel bigger than the reserve needs all of its own space
+    est = precheck.SpaceEstimate(MOUNTS)
+    est.add('/boot/vmlinuz-huge', reserve + 100)
+    est.reserve('/boot', reserve)
+    assert est.needs['/boot'] == reserve + 100
+
+    # with nothing new in /boot, it's just the reserve
+    est = precheck.SpaceEstimate(MOUNTS)
+    est.reserve('/boot/grub', reserve)
+    assert est.needs == {'/boot': reserve}
@@ -0,0 +1,36 @@
+from redhat_upgrade_tool import problems
+
+
+class Problem(object):
+    """ stands in for an rpm problem """
+    def __init__(self, type, pkgNEVR, altNEVR, _str):
+        self.type = type
+        self.pkgNEVR = pkgNEVR
+        self.altNEVR = altNEVR
+        self._str = _str
+
+
+def test_group_problems():
+    """ group_problems sorts problems by type, keeping their order """
+    p1 = Problem(1, 'a-1.0-1.x86_64', 'b', '')
+    p2 = Problem(2, 'a-1.0-1.x86_64', 'c', '')
+    p3 = Problem(1, 'd-1.0-1.x86_64', 'e', '')
+    assert problems.group_problems([p1, p2, p3]) == {1: [p1, p3], 2: [p2]}
+    assert problems.group_problems([]) == {}
+
+
+def test_problem_report():
+    """ problem_report counts problems by type and by package """
+    probs = [Problem(1, 'a', 'foo >= 2', None),
+             Problem(1, 'b', 'bar', None),
+             Problem(2, 'a', 'c', '/usr/bin/x'),
+             Problem(3, 'c', 'd', '/usr/bin/y')]
+    report = problems.problem_report(probs, {1: 'requires', 2: 'conflict'},
+                                     top=2)
+    assert report['total'] == 4
+    assert report['counts'] == {'requires': 2, 'conflict': 1, '3': 1}
+    assert report['top'] == [('a', 2), ('b', 1)]
+    assert report['packages']['a'] == [
+        dict(type='requires', other='foo >= 2', detail=None),
+        dict(type='conflict', other='c', detail='/usr/bin/x'),
+    ]
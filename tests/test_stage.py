@@ -0,0 +1,31 @@
+import os
+from redhat_upgrade_tool import stage
+
+
+def test_copy_file(tmpdir):
+    """ copy_file copies the data and the timestamps """
+    src = tmpdir.join('src.rpm')
+    src.write('x' * 100000)
+    os.utime(str(src), (1000000000, 1000000000))
+    dst = tmpdir.join('dst.rpm')
+    method = stage.copy_file(str(src), str(dst))
+    assert method in [m for (m, func) in stage.copy_methods]
+    assert dst.read() == src.read()
+    assert os.stat(str(dst)).st_mtime == 1000000000
+
+
+def test_stage_files(tmpdir):
+    """ stage_files links new files and skips ones that are already there """
+    cache = tmpdir.mkdir('cache')
+    dest = tmpdir.mkdir('dest')
+    for name in ('a.rpm', 'b.rpm'):
+        cache.join(name).write(name)
+    files = [(str(cache.join(n)), n) for n in ('a.rpm', 'b.rpm', 'c.rpm')]
+
+    staged, stats = stage.stage_files(files, str(dest), workers=2)
+    assert staged == set(['a.rpm', 'b.rpm'])
+    assert stats == {'link': [2, 10]}
+    assert dest.join('a.rpm').read() == 'a.rpm'
+
+    staged, stats = stage.stage_files(files, str(dest))
+    assert stats == {'present': [2, 10]}
@@ -70,3 +70,42 @@ def test_hrsize():
     for entry in data:
         actual = util.hrsize(entry['size'], entry['si'], entry['use_ib'])
         assert actual == entry['expected']
+
+
+def test_worker_count():
+    """ worker_count returns at least one worker """
+    assert util.worker_count(4) == 4
+    assert util.worker_count(0) == 1
+    assert util.worker_count() >= 1
+
+
+def test_parallel_imap():
+    """ parallel_imap returns results in the order of the input items """
+    items = [-3, 2, -1, 0, 5, -8, 13]
+    expected = [abs(i) for i in items]
+    assert list(util.parallel_imap(abs, items, workers=1)) == expected
+    assert list(util.parallel_imap(abs, items, workers=3)) == expected
+    assert list(util.parallel_imap(abs, items, workers=3, threads=True)) == expected
+    assert list(util.parallel_imap(abs, [], workers=3)) == []
+
+
+def test_phase_timer():
+    """ PhaseTimer adds up the time spent in each phase, in order """
+    clock = iter([0.0, 1.5, 2.0, 2.25, 3.0, 4.0]).next
+    timer = util.PhaseTimer(clock=clock)
+    with timer.phase('check'):
+        pass
+    with timer.phase('order'):
+        pass
+    with timer.phase('check'):
+        pass
+    assert timer.record() == [('check', 2.5), ('order', 0.25)]
+
+
+def test_save_json(tmpdir):
+    """ save_json writes the data, or returns False if it can't """
+    filename = str(tmpdir.join('data.json'))
+    assert util.save_json(filename, {'a': [1, 2]}, "test data")
+    assert open(filename).read() == '{"a": [1, 2]}'
+    assert not util.save_json(filename, {'a': object()}, "test data")
+    assert not util.save_json(str(tmpdir.join('no/such/dir')), {}, "test data")